@@ -0,0 +1,128 @@
+"""Measure Worker.flush_messages over long trajectories against the old rescanning flush.
+
+Agents are driven with a stub engine and tiny images, so only message bookkeeping is
+timed. No request is sent to any provider.
+
+    python benchmarks/flush_benchmark.py --steps 500 1000 2000 --provider anthropic
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gui_agents.s2_5.agents.worker import Worker  # noqa: E402
+from gui_agents.s2_5.core.mllm import LMMAgent  # noqa: E402
+
+FORMATS = {"openai": "openai", "anthropic": "anthropic", "vllm": "vllm"}
+
+
+class StubEngine:
+    def __init__(self, provider):
+        self.provider = provider
+        self.message_format = FORMATS[provider]
+
+
+def rescanning_flush(self):
+    """flush_messages as it was: count every image, then delete while iterating"""
+    engine_type = self.generator_agent.engine.provider
+    if engine_type in ["anthropic", "openai", "gemini"]:
+        max_images = self.max_trajectory_length
+        eviction_batch = max(1, max_images // 2) if engine_type == "anthropic" else 1
+        for agent in [self.generator_agent, self.reflection_agent]:
+            total_images = sum(
+                "image" in part.get("type", "")
+                for message in agent.messages
+                for part in message["content"]
+            )
+            if total_images <= max_images:
+                continue
+            keep_images = max_images - eviction_batch + 1
+            img_count = 0
+            for i in range(len(agent.messages) - 1, -1, -1):
+                for j in range(len(agent.messages[i]["content"]) - 1, -1, -1):
+                    if "image" in agent.messages[i]["content"][j].get("type", ""):
+                        img_count += 1
+                        if img_count > keep_images:
+                            del agent.messages[i]["content"][j]
+    else:
+        if len(self.generator_agent.messages) > 2 * self.max_trajectory_length + 1:
+            self.generator_agent.messages.pop(1)
+            self.generator_agent.messages.pop(1)
+        if len(self.reflection_agent.messages) > self.max_trajectory_length + 1:
+            self.reflection_agent.messages.pop(1)
+
+
+def screenshots(count):
+    from PIL import Image
+
+    images = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (8, 8), (i * 37 % 256, i * 91 % 256, i % 256)).save(
+            buffer, "PNG"
+        )
+        images.append(buffer.getvalue())
+    return images
+
+
+def run(flush, provider, steps, images, max_trajectory_length):
+    """Simulate steps worker turns, return (total flush seconds, last step flush seconds)"""
+    worker = SimpleNamespace(
+        generator_agent=LMMAgent(engine=StubEngine(provider)),
+        reflection_agent=LMMAgent(engine=StubEngine(provider)),
+        max_trajectory_length=max_trajectory_length,
+        context_budgets={},
+        context_tokens={},
+        reflection_summary=None,
+    )
+    if flush is rescanning_flush:
+        # The old flush edits messages directly, so the agents must not track images
+        for agent in (worker.generator_agent, worker.reflection_agent):
+            agent._track_images = lambda message: None
+    total = last = 0.0
+    for step in range(steps):
+        screenshot = images[step % len(images)]
+        worker.reflection_agent.add_message(
+            "reflect", image_content=screenshot, role="user"
+        )
+        worker.generator_agent.add_message(
+            "observe", image_content=screenshot, role="user"
+        )
+        worker.generator_agent.add_message("plan", role="assistant")
+        started = time.perf_counter()
+        flush(worker)
+        last = time.perf_counter() - started
+        total += last
+    return total, last
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--provider", default="anthropic", choices=sorted(FORMATS))
+    parser.add_argument("--max-trajectory-length", type=int, default=8)
+    args = parser.parse_args()
+
+    images = screenshots(32)
+    for steps in args.steps:
+        for label, flush in (
+            ("rescanning", rescanning_flush),
+            ("incremental", Worker.flush_messages),
+        ):
+            total, last = run(
+                flush, args.provider, steps, images, args.max_trajectory_length
+            )
+            print(
+                f"{steps:>6} steps {label:>11}: total {total * 1000:8.1f} ms, "
+                f"mean {total / steps * 1e6:7.1f} us/step, "
+                f"last step {last * 1e6:7.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Measure the startup of python wordle.py, up to the first prompt.
+
+Each run is a fresh interpreter that goes through wordle.py's own startup path and
+times its phases: importing wordle (the agent package, rich, dotenv and the
+configuration), creating the local Executor (which imports pyautogui) and
+create_agent. Settings come from .env as in a real run, with the model settings
+overridden from the command line and dummy credentials, so no request is sent to
+any provider. Connection warm-up is left off unless --warm-up is given, since it
+opens real connections. The remote Executor is not timed: it boots an Orgo VM,
+which is not startup work of this process. pyautogui needs a display.
+
+    python benchmarks/startup_benchmark.py --runs 10 --engine openai
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_SNIPPET = """
+import json, time
+
+start = time.perf_counter()
+import wordle
+
+imported = time.perf_counter()
+executor = wordle.Executor(remote=False)
+executor_ready = time.perf_counter()
+wordle.create_agent(executor)
+created = time.perf_counter()
+print(json.dumps({
+    "import wordle": imported - start,
+    "executor": executor_ready - imported,
+    "create_agent": created - executor_ready,
+}))
+"""
+
+DEFAULT_MODELS = {
+    "openai": "gpt-4o",
+    "anthropic": "claude-3-7-sonnet-20250219",
+    "gemini": "gemini-2.5-pro",
+}
+
+DUMMY_ENV = {
+    "OPENAI_API_KEY": "sk-dummy",
+    "ANTHROPIC_API_KEY": "sk-ant-dummy",
+    "GEMINI_API_KEY": "dummy",
+    "GEMINI_ENDPOINT_URL": "http://localhost:9/v1",
+}
+
+
+def run_snippet(snippet, env=None, importtime=False):
+    """Run snippet in a fresh interpreter, return (wall seconds, stdout, stderr)"""
+    env = dict(os.environ, **DUMMY_ENV, **(env or {}))
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ["-X", "importtime"]
+    cmd += ["-c", snippet]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"snippet failed:\n{proc.stderr[-2000:]}")
+    return elapsed, proc.stdout, proc.stderr
+
+
+def top_imports(importtime_output, n, module="wordle", skip=()):
+    """Parse -X importtime output into the n slowest imports (cumulative us) made at
+    startup: directly by module, or later at the top level (e.g. lazy SDK imports)"""
+    totals = {}
+    # Children are reported before their parent, one level (2 spaces) deeper
+    children = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name, cumulative = name.strip(), int(cumulative)
+        nested = children.pop(depth + 1, [])
+        if depth > 0:
+            children.setdefault(depth, []).append((name, cumulative))
+        elif name == module:
+            totals.update(nested)
+        elif name not in skip:
+            totals[name] = cumulative
+    return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--engine", default="openai", choices=sorted(DEFAULT_MODELS))
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--warm-up", action="store_true")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    model = args.model or DEFAULT_MODELS[args.engine]
+    env = {
+        "AGENT_MODEL_TYPE": args.engine,
+        "AGENT_MODEL": model,
+        "GROUNDING_MODEL_TYPE": args.engine,
+        "GROUNDING_MODEL": model,
+        "WARM_UP_CONNECTIONS": "true" if args.warm_up else "false",
+    }
+    baseline = statistics.median(run_snippet("pass")[0] for _ in range(args.runs))
+    phases, totals = {}, []
+    for _ in range(args.runs):
+        elapsed, stdout, _ = run_snippet(STARTUP_SNIPPET, env)
+        totals.append(elapsed - baseline)
+        for label, seconds in json.loads(stdout.splitlines()[-1]).items():
+            phases.setdefault(label, []).append(seconds)
+    for label, times in [*phases.items(), ("total", totals)]:
+        print(
+            f"{label:>13}: median {statistics.median(times) * 1000:.0f} ms, "
+            f"min {min(times) * 1000:.0f} ms over {args.runs} runs"
+        )
+
+    # Modules every interpreter imports before running any code
+    _, _, stderr = run_snippet("pass", importtime=True)
+    interpreter = {name for name, _ in top_imports(stderr, None)}
+    _, _, stderr = run_snippet(STARTUP_SNIPPET, env, importtime=True)
+    print(f"\nslowest startup imports ({args.engine}):")
+    for name, micros in top_imports(stderr, args.top, skip=interpreter):
+        print(f"  {micros / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
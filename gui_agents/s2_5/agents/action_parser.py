@@ -0,0 +1,131 @@
+import ast
+import inspect
+import threading
+from typing import Any, Dict, List, Optional
+
+from gui_agents.s2_5.utils.common_utils import (
+    extract_agent_functions,
+    parse_single_code_from_string,
+    sanitize_code,
+)
+
+_signatures = {}  # (ACI class, method name) -> inspect.Signature
+_signatures_lock = threading.Lock()
+
+
+class ParsedAction:
+    """One agent.<name>(...) call from a plan, validated against the ACI.
+
+    arguments holds the call's literal arguments bound by name to the ACI method's
+    signature, so grounding reads its referring expressions from here and calling
+    the action runs the method directly instead of evaluating model output.
+    """
+
+    __slots__ = ("name", "arguments", "args", "kwargs", "code")
+
+    def __init__(self, name: str, args: tuple, kwargs: Dict, bound: Dict, code: str):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.arguments = bound
+        # Canonical source of the call, e.g. agent.hotkey(['enter'])
+        self.code = code
+
+    def get(self, argument: str, default: Any = None) -> Any:
+        return self.arguments.get(argument, default)
+
+    def __call__(self, aci) -> str:
+        """The executable code the ACI generates for this action"""
+        return getattr(aci, self.name)(*self.args, **self.kwargs)
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedAction) and self.code == other.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return f"ParsedAction({self.code})"
+
+
+def _signature(aci_class, name: str) -> inspect.Signature:
+    key = (aci_class, name)
+    with _signatures_lock:
+        if key not in _signatures:
+            method = getattr(aci_class, name, None)
+            if not getattr(method, "is_agent_action", False):
+                raise ValueError(f"agent.{name} is not an agent action")
+            _signatures[key] = inspect.signature(method)
+        return _signatures[key]
+
+
+def _literal(node: ast.AST):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError) as e:
+        raise ValueError(f"Argument {ast.unparse(node)} is not a literal") from e
+
+
+def _parse_call(node: ast.Call, aci_class) -> ParsedAction:
+    name = node.func.attr
+    args = tuple(_literal(arg) for arg in node.args)
+    if any(keyword.arg is None for keyword in node.keywords):
+        raise ValueError(f"agent.{name} uses ** arguments")
+    kwargs = {keyword.arg: _literal(keyword.value) for keyword in node.keywords}
+    try:
+        bound = _signature(aci_class, name).bind(None, *args, **kwargs)
+    except TypeError as e:
+        raise ValueError(f"Invalid arguments for agent.{name}: {e}") from e
+    arguments = dict(bound.arguments)
+    # The first parameter is self
+    arguments.pop(next(iter(arguments)))
+    return ParsedAction(name, args, kwargs, arguments, ast.unparse(node))
+
+
+def _agent_calls(tree: ast.AST) -> List[ast.Call]:
+    calls = []
+    for statement in getattr(tree, "body", []):
+        node = statement.value if isinstance(statement, ast.Expr) else None
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == "agent"
+        ):
+            calls.append(node)
+    return calls
+
+
+def parse_actions(
+    code: str, aci_class, limit: Optional[int] = None
+) -> List[ParsedAction]:
+    """The first limit (default all) agent actions called at the top level of code.
+
+    Code that does not parse as a whole (e.g. a double-quoted string spanning lines,
+    or prose around the calls) is retried with the multi-line string quoted, then
+    call by call. Raises ValueError for calls that are not literal agent actions.
+    """
+    calls = None
+    for candidate in (code, sanitize_code(code)):
+        try:
+            calls = _agent_calls(ast.parse(candidate.strip()))
+            break
+        except SyntaxError:
+            continue
+    if calls is None:
+        calls = []
+        for function in extract_agent_functions(sanitize_code(code)):
+            try:
+                calls += _agent_calls(ast.parse(function))
+            except SyntaxError:
+                continue
+    return [_parse_call(call, aci_class) for call in calls[:limit]]
+
+
+def parse_plan(plan: str, aci_class, limit: Optional[int] = None) -> List[ParsedAction]:
+    """The actions of a plan's grounded action code block; raises ValueError if none"""
+    code = parse_single_code_from_string(plan.split("Grounded Action")[-1])
+    actions = parse_actions(code, aci_class, limit)
+    if not actions:
+        raise ValueError(f"No agent action found in {code!r}")
+    return actions
@@ -1,19 +1,12 @@
-import ast
 import re
 from collections import defaultdict
 from io import BytesIO
 from typing import Any, Dict, List, Optional, Tuple, Union
 
-import pytesseract
-from PIL import Image
-from pytesseract import Output
-
+from gui_agents.s2_5.agents.action_parser import ParsedAction, parse_plan
 from gui_agents.s2_5.memory.procedural_memory import PROCEDURAL_MEMORY
 from gui_agents.s2_5.core.mllm import LMMAgent
-from gui_agents.s2_5.utils.common_utils import (
-    call_llm_safe,
-    parse_single_code_from_string,
-)
+from gui_agents.s2_5.utils.common_utils import call_llm_safe
 
 
 class ACI:
@@ -181,13 +174,14 @@ class OSWorldACI(ACI):
         self.coords2 = None
 
         # Configure the visual grounding model responsible for coordinate generation
-        self.grounding_model = LMMAgent(engine_params_for_grounding)
+        self.grounding_model = LMMAgent(engine_params_for_grounding, role="grounding")
         self.engine_params_for_grounding = engine_params_for_grounding
 
         # Configure text grounding agent
         self.text_span_agent = LMMAgent(
             engine_params=engine_params_for_generation,
             system_prompt=PROCEDURAL_MEMORY.PHRASE_TO_WORD_COORDS_PROMPT,
+            role="text_span",
         )
 
     # Given the state and worker's referring expression, use the grounding model to generate (x,y)
@@ -207,10 +201,30 @@ class OSWorldACI(ACI):
         #print("RAW GROUNDING MODEL RESPONSE:", response)
         numericals = re.findall(r"\d+", response)
         assert len(numericals) >= 2
-        return [int(numericals[0]), int(numericals[1])]
+        coords = [int(numericals[0]), int(numericals[1])]
+
+        # Undo the preprocessor's own downscaling (if any), so the point means the same
+        # as for the screenshot sent unchanged
+        preprocessor = self.grounding_model.image_preprocessor
+        if preprocessor is not None:
+            from PIL import Image
+
+            width, height = Image.open(BytesIO(obs["screenshot"])).size
+            sent_width, sent_height = preprocessor.output_size(width, height)
+            if (sent_width, sent_height) != (width, height):
+                coords = [
+                    round(coords[0] * width / sent_width),
+                    round(coords[1] * height / sent_height),
+                ]
+        return coords
 
     # Calls pytesseract to generate word level bounding boxes for text grounding
     def get_ocr_elements(self, b64_image_data: str) -> Tuple[str, List]:
+        # The OCR stack is only needed for highlight_text_span, import it on first use
+        import pytesseract
+        from PIL import Image
+        from pytesseract import Output
+
         image = Image.open(BytesIO(b64_image_data))
         image_data = pytesseract.image_to_data(image, output_type=Output.DICT)
 
@@ -290,36 +304,45 @@ class OSWorldACI(ACI):
             ]
         return coords
 
+    # Referring expressions of the coordinate based actions, grounded into coords1 and coords2
+    GROUNDED_ARGUMENTS = {
+        "click": ("element_description",),
+        "type": ("element_description",),
+        "scroll": ("element_description",),
+        "drag_and_drop": ("starting_description", "ending_description"),
+        "highlight_text_span": ("starting_phrase", "ending_phrase"),
+    }
+
+    def grounding_targets(self, action: ParsedAction) -> List[str]:
+        """The referring expressions action needs coordinates for, empty if none"""
+        targets = [action.get(name) for name in self.GROUNDED_ARGUMENTS.get(action.name, ())]
+        return targets if all(target is not None for target in targets) else []
+
     # Takes a description based action and assigns the coordinates for any coordinate based action
     # Raises an error if function can't be parsed
-    def assign_coordinates(self, plan: str, obs: Dict):
+    def assign_coordinates(self, plan: Union[str, ParsedAction], obs: Dict):
 
         # Reset coords from previous action generation
         self.coords1, self.coords2 = None, None
 
-        try:
-            # Extract the function name and args
-            action = parse_single_code_from_string(plan.split("Grounded Action")[-1])
-            function_name = re.match(r"(\w+\.\w+)\(", action).group(1)
-            args = self.parse_function_args(action)
-        except Exception as e:
-            raise RuntimeError(f"Error in parsing grounded action: {e}") from e
-
-        # arg0 is a description
-        if (
-            function_name in ["agent.click", "agent.type", "agent.scroll"]
-            and len(args) >= 1
-            and args[0] != None
-        ):
-            self.coords1 = self.generate_coords(args[0], obs)
-        # arg0 and arg1 are descriptions
-        elif function_name == "agent.drag_and_drop" and len(args) >= 2:
-            self.coords1 = self.generate_coords(args[0], obs)
-            self.coords2 = self.generate_coords(args[1], obs)
+        if isinstance(plan, ParsedAction):
+            action = plan
+        else:
+            try:
+                action = parse_plan(plan, type(self), limit=1)[0]
+            except Exception as e:
+                raise RuntimeError(f"Error in parsing grounded action: {e}") from e
+
+        targets = self.grounding_targets(action)
         # arg0 and arg1 are text phrases
-        elif function_name == "agent.highlight_text_span" and len(args) >= 2:
-            self.coords1 = self.generate_text_coords(args[0], obs, alignment="start")
-            self.coords2 = self.generate_text_coords(args[1], obs, alignment="end")
+        if action.name == "highlight_text_span" and targets:
+            self.coords1 = self.generate_text_coords(targets[0], obs, alignment="start")
+            self.coords2 = self.generate_text_coords(targets[1], obs, alignment="end")
+        # arg0 (and arg1) are descriptions
+        elif targets:
+            self.coords1 = self.generate_coords(targets[0], obs)
+            if len(targets) > 1:
+                self.coords2 = self.generate_coords(targets[1], obs)
 
     # Resize from grounding model dim into OSWorld dim (1920 * 1080)
     def resize_coordinates(self, coordinates: List[int]) -> List[int]:
@@ -331,33 +354,6 @@ class OSWorldACI(ACI):
             round(coordinates[1] * self.height / grounding_height),
         ]
 
-    # Given a generated ACI function, returns a list of argument values, where descriptions are at the front of the list
-    def parse_function_args(self, function: str) -> List[str]:
-        tree = ast.parse(function)
-        call_node = tree.body[0].value
-
-        def safe_eval(node):
-            if isinstance(
-                node, ast.Constant
-            ):  # Handles literals like numbers, strings, etc.
-                return node.value
-            else:
-                return ast.unparse(node)  # Return as a string if not a literal
-
-        positional_args = [safe_eval(arg) for arg in call_node.args]
-        keyword_args = {kw.arg: safe_eval(kw.value) for kw in call_node.keywords}
-
-        res = []
-
-        for key, val in keyword_args.items():
-            if "description" in key:
-                res.append(val)
-
-        for arg in positional_args:
-            res.append(arg)
-
-        return res
-
     @agent_action
     def click(
         self,
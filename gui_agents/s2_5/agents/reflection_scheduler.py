@@ -0,0 +1,61 @@
+from collections import deque
+from typing import Dict, Optional
+
+# Used in place of a model reflection on steps where nothing calls for one
+LOCAL_REFLECTION = (
+    "Case 2. The trajectory is going according to plan. "
+    "Continue proceeding as planned."
+)
+
+
+class ReflectionScheduler:
+    """Decides on which steps the reflection model is worth calling.
+
+    A reflection is requested when the last action raised an error, when the last
+    repeat_window actions were identical, when the screen has not changed for
+    stall_steps steps in a row, or as a heartbeat once heartbeat steps have passed
+    without one. Every other step gets LOCAL_REFLECTION instead.
+    """
+
+    def __init__(
+        self, repeat_window: int = 3, stall_steps: int = 2, heartbeat: int = 5
+    ):
+        self.repeat_window = repeat_window
+        self.stall_steps = stall_steps
+        self.heartbeat = heartbeat
+        self.recent_actions = deque(maxlen=repeat_window)
+        self.unchanged_steps = 0
+        self.steps_since_reflection = 0
+        self.stats = {"local": 0}
+
+    def record_action(self, plan_code: Optional[str]):
+        """Remember the action a step ended with"""
+        self.recent_actions.append(plan_code)
+
+    def trigger(self, screen_changed: bool, action_error=None) -> Optional[str]:
+        """Why this step needs a model reflection, or None if the local one will do"""
+        self.unchanged_steps = 0 if screen_changed else self.unchanged_steps + 1
+        self.steps_since_reflection += 1
+        reason = None
+        if action_error:
+            reason = "action_error"
+        elif (
+            len(self.recent_actions) == self.repeat_window
+            and len(set(self.recent_actions)) == 1
+        ):
+            reason = "repeated_actions"
+        elif self.unchanged_steps >= self.stall_steps:
+            reason = "no_progress"
+        elif self.heartbeat and self.steps_since_reflection >= self.heartbeat:
+            reason = "heartbeat"
+
+        if reason is None:
+            self.stats["local"] += 1
+        else:
+            self.stats[reason] = self.stats.get(reason, 0) + 1
+            self.steps_since_reflection = 0
+        return reason
+
+    def summary(self) -> Dict:
+        called = sum(count for key, count in self.stats.items() if key != "local")
+        return {**self.stats, "called": called}
@@ -0,0 +1,113 @@
+import logging
+import re
+from typing import List, Optional
+
+from gui_agents.s2_5.utils.common_utils import (
+    call_llm_safe,
+    extract_first_agent_function,
+    parse_single_code_from_string,
+)
+
+logger = logging.getLogger("desktopenv.agent")
+
+COLOR_PATTERN = re.compile(r"\b(green|yellow|gr[ae]y|black)\b", re.IGNORECASE)
+GUESS_PATTERN = re.compile(r"agent\.(?:write|type)\(\s*['\"]([A-Za-z]+)['\"]")
+VERIFICATION_PATTERN = re.compile(
+    r"\(Previous action verification\)\s*(.*?)(?=\n\s*\([A-Z][^)\n]*\)|\Z)", re.DOTALL
+)
+
+
+class TrajectorySummarizer:
+    """Folds older turns of a trajectory into a compact structured summary.
+
+    Every folded plan is parsed for the guess it entered, the color feedback it
+    reported for the previous guess and its grounded action, from which repeated
+    actions and guesses are flagged as loops. The summary is rendered from that state
+    by a fixed template, or written by summary_agent (typically a cheaper model) when
+    one is given, falling back to the template if the call fails.
+    """
+
+    def __init__(self, summary_agent=None, max_feedback_chars: int = 200):
+        self.summary_agent = summary_agent
+        self.max_feedback_chars = max_feedback_chars
+        self.turns = 0
+        self.guesses = []  # (turn, word)
+        self.feedback = []  # (turn, text)
+        self.actions = []  # grounded action of every folded turn
+        self.summary = None
+
+    def _record(self, plan: str):
+        self.turns += 1
+        match = VERIFICATION_PATTERN.search(plan)
+        if match:
+            sentences = re.split(r"(?<=[.!?])\s+", match.group(1).strip())
+            colors = " ".join(s for s in sentences if COLOR_PATTERN.search(s))
+            if colors:
+                self.feedback.append((self.turns, colors[: self.max_feedback_chars]))
+        grounded = plan.split("Grounded Action")[-1]
+        action = extract_first_agent_function(parse_single_code_from_string(grounded))
+        self.actions.append(action)
+        guess = GUESS_PATTERN.search(action or "")
+        if guess:
+            self.guesses.append((self.turns, guess.group(1).upper()))
+
+    def loops(self) -> List[str]:
+        """Actions repeated on consecutive turns and words guessed more than once"""
+        found = []
+        start = 0
+        for i in range(1, len(self.actions) + 1):
+            if i < len(self.actions) and self.actions[i] == self.actions[start]:
+                continue
+            if self.actions[start] and i - start >= 2:
+                found.append(
+                    f"{self.actions[start]} repeated {i - start} times "
+                    f"(turns {start + 1}-{i})"
+                )
+            start = i
+        words = [word for _, word in self.guesses]
+        for word in sorted(set(words)):
+            if words.count(word) > 1:
+                found.append(f"{word} guessed {words.count(word)} times")
+        return found
+
+    def render(self) -> str:
+        """The accumulated state as a structured plain-text summary"""
+        guesses = ", ".join(f"{word} (turn {turn})" for turn, word in self.guesses)
+        lines = [
+            f"Summary of turns 1-{self.turns}:",
+            f"Guesses made: {guesses or 'none'}",
+            "Color feedback:",
+        ]
+        lines += [f"- turn {turn}: {text}" for turn, text in self.feedback] or [
+            "- none reported"
+        ]
+        lines.append(f"Detected loops: {'; '.join(self.loops()) or 'none'}")
+        return "\n".join(lines)
+
+    def fold(self, plans: List[str]) -> str:
+        """Add plans (oldest first) to the summary and return the updated summary"""
+        previous = self.summary
+        first_turn = self.turns + 1
+        for plan in plans:
+            self._record(plan)
+        self.summary = self._summarize(plans, first_turn, previous) or self.render()
+        return self.summary
+
+    def _summarize(self, plans, first_turn, previous) -> Optional[str]:
+        if self.summary_agent is None:
+            return None
+        turns = "\n\n".join(
+            f"Turn {first_turn + i}:\n{plan}" for i, plan in enumerate(plans)
+        )
+        self.summary_agent.reset()
+        self.summary_agent.add_message(
+            f"Previous summary:\n{previous or 'none'}\n\n"
+            f"Turns to fold in:\n{turns}\n\n"
+            f"Facts extracted from all turns so far:\n{self.render()}",
+            role="user",
+        )
+        try:
+            return call_llm_safe(self.summary_agent).strip() or None
+        except Exception as e:
+            logger.warning("Trajectory summary call failed, using the template: %s", e)
+            return None
@@ -0,0 +1,255 @@
+import functools
+import io
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("desktopenv.agent")
+
+GRAY, YELLOW, GREEN = 0, 1, 2
+SOLVED = (GREEN,) * 5
+COLOR_NAMES = {GRAY: "gray", YELLOW: "yellow", GREEN: "green"}
+# Tile fill colors of common Wordle clones, light and dark themes (RGB)
+TILE_COLORS = {
+    GREEN: [(106, 170, 100), (83, 141, 78), (121, 184, 81)],
+    YELLOW: [(201, 180, 88), (181, 159, 59), (243, 194, 55)],
+    GRAY: [(120, 124, 126), (58, 58, 60), (164, 174, 196)],
+}
+# Searched in order when no word list is configured
+DEFAULT_WORD_LISTS = ["/usr/share/dict/words", "/usr/dict/words"]
+WORD_LENGTH = 5
+
+
+@functools.lru_cache(maxsize=4)
+def load_words(path: str) -> Tuple[str, ...]:
+    """The distinct five-letter alphabetic words of a word list, upper-cased"""
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        words = {
+            line.strip().upper()
+            for line in f
+            if len(line.strip()) == WORD_LENGTH
+            and line.strip().isascii()
+            and line.strip().isalpha()
+            # Skip the proper nouns of system dictionaries
+            and not line.strip().istitle()
+        }
+    return tuple(sorted(words))
+
+
+def find_word_list(path: Optional[str] = None) -> Optional[str]:
+    """path if given, else the first system dictionary found; None if unavailable"""
+    for candidate in [path] if path else DEFAULT_WORD_LISTS:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def feedback(guess: str, answer: str) -> Tuple[int, ...]:
+    """Colors Wordle shows for guess against answer, repeated letters included"""
+    pattern = [GRAY] * WORD_LENGTH
+    remaining = {}
+    for i, (g, a) in enumerate(zip(guess, answer)):
+        if g == a:
+            pattern[i] = GREEN
+        else:
+            remaining[a] = remaining.get(a, 0) + 1
+    for i, g in enumerate(guess):
+        if pattern[i] != GREEN and remaining.get(g, 0) > 0:
+            pattern[i] = YELLOW
+            remaining[g] -= 1
+    return tuple(pattern)
+
+
+def _encode(words: Sequence[str]) -> np.ndarray:
+    return np.frombuffer("".join(words).encode("ascii"), dtype=np.uint8).reshape(
+        -1, WORD_LENGTH
+    ) - ord("A")
+
+
+class WordleSolver:
+    """Picks Wordle guesses locally by expected information.
+
+    The candidates are the words consistent with all feedback so far. Each guess
+    from a pool of at most max_pool words (candidates first) is scored by the
+    entropy of the feedback patterns it would produce over the candidates, so the
+    chosen guess splits the remaining words as evenly as possible.
+    """
+
+    def __init__(
+        self, words: Sequence[str], opening: Optional[str] = None, max_pool: int = 1500
+    ):
+        self.words = list(words)
+        self.opening = opening.upper() if opening else None
+        self.max_pool = max_pool
+        self.reset()
+
+    def reset(self):
+        self.candidates = list(self.words)
+        self.history: List[Tuple[str, Tuple[int, ...]]] = []
+
+    def update(self, guess: str, pattern: Sequence[int]):
+        """Keep the candidates that would have produced pattern for guess"""
+        guess, pattern = guess.upper(), tuple(pattern)
+        self.history.append((guess, pattern))
+        self.candidates = [
+            word for word in self.candidates if feedback(guess, word) == pattern
+        ]
+
+    def discard(self, word: str):
+        """Never suggest word again, e.g. after the game rejected it"""
+        word = word.upper()
+        if self.opening == word:
+            self.opening = None
+        self.words = [w for w in self.words if w != word]
+        self.candidates = [w for w in self.candidates if w != word]
+
+    @property
+    def solved(self) -> bool:
+        return bool(self.history) and self.history[-1][1] == SOLVED
+
+    def _patterns(self, guess: str, answers: np.ndarray, counts: np.ndarray):
+        """Feedback pattern codes (base 3) of guess against every encoded answer"""
+        letters = _encode([guess])[0]
+        green = answers == letters
+        # Answer letters left for yellows once the greens are taken
+        remaining = {letter: counts[:, letter].copy() for letter in set(letters)}
+        for i, letter in enumerate(letters):
+            remaining[letter] -= green[:, i]
+        codes = np.zeros(len(answers), dtype=np.int32)
+        for i, letter in enumerate(letters):
+            yellow = ~green[:, i] & (remaining[letter] > 0)
+            remaining[letter] -= yellow
+            codes += (2 * green[:, i] + yellow) * 3**i
+        return codes
+
+    def _pool(self) -> List[str]:
+        # Evenly spaced over the word lists, so every run picks the same pool
+        step = max(1, len(self.candidates) // self.max_pool)
+        pool = self.candidates[::step][: self.max_pool]
+        room = self.max_pool - len(pool)
+        if room > 0:
+            chosen = set(pool)
+            others = [word for word in self.words if word not in chosen]
+            pool += others[:: max(1, len(others) // room)][:room]
+        return pool
+
+    def rank(self, limit: int = 5) -> List[Tuple[str, float]]:
+        """The best guesses with their expected information in bits"""
+        if len(self.candidates) <= 2:
+            return [
+                (word, 1.0 if len(self.candidates) == 2 else 0.0)
+                for word in self.candidates
+            ]
+        answers = _encode(self.candidates)
+        counts = np.zeros((len(answers), 26), dtype=np.int8)
+        for i in range(WORD_LENGTH):
+            np.add.at(counts, (np.arange(len(answers)), answers[:, i]), 1)
+        candidates = set(self.candidates)
+        scores = []
+        for guess in self._pool():
+            frequencies = np.bincount(
+                self._patterns(guess, answers, counts), minlength=3**WORD_LENGTH
+            )
+            p = frequencies[frequencies > 0] / len(answers)
+            entropy = float(-(p * np.log2(p)).sum())
+            # Between equally informative guesses, prefer one that can win now
+            bonus = 1 / len(answers) if guess in candidates else 0.0
+            scores.append((entropy + bonus, guess, entropy))
+        scores.sort(key=lambda score: (-score[0], score[1]))
+        return [(guess, entropy) for _, guess, entropy in scores[:limit]]
+
+    def next_guess(self) -> Optional[str]:
+        """The guess to play next, None when no word fits the feedback"""
+        if not self.candidates:
+            return None
+        if not self.history:
+            # The opening only depends on the word list, rank it once
+            if self.opening is None:
+                self.opening = self.rank(limit=1)[0][0]
+            return self.opening
+        return self.rank(limit=1)[0][0]
+
+    def describe(self) -> str:
+        """The guesses, their feedback and the candidates left, in plain text"""
+        guesses = "; ".join(
+            f"{guess} ({', '.join(COLOR_NAMES[color] for color in pattern)})"
+            for guess, pattern in self.history
+        )
+        shown = ", ".join(self.candidates[:10])
+        more = (
+            f" and {len(self.candidates) - 10} more"
+            if len(self.candidates) > 10
+            else ""
+        )
+        return (
+            f"Guesses so far: {guesses or 'none'}. "
+            f"{len(self.candidates)} words still fit the feedback: {shown or 'none'}{more}."
+        )
+
+
+def read_board(
+    screenshot: bytes,
+    colors: Optional[Dict[int, List[Tuple[int, int, int]]]] = None,
+    tolerance: float = 40.0,
+) -> List[Tuple[int, ...]]:
+    """Color patterns of the scored rows of a Wordle board, top to bottom.
+
+    Pixels are labeled by their nearest tile color within tolerance. A scored row is
+    a horizontal band holding exactly five equally sized, roughly square and closely
+    spaced runs of labeled pixels, aligned with the first such band. Keys of the
+    on-screen keyboard are taller than wide and lie between unscored keys.
+    """
+    colors = colors or TILE_COLORS
+    image = np.asarray(
+        Image.open(io.BytesIO(screenshot)).convert("RGB"), dtype=np.int32
+    )
+    labels = np.full(image.shape[:2], -1, dtype=np.int8)
+    best = np.full(image.shape[:2], tolerance**2, dtype=np.float32)
+    for color, references in colors.items():
+        for reference in references:
+            distance = ((image - np.array(reference, dtype=np.int32)) ** 2).sum(-1)
+            closer = distance < best
+            labels[closer] = color
+            best[closer] = distance[closer]
+    labeled = labels >= 0
+
+    min_tile = max(8, image.shape[1] // 80)
+    rows = []
+    layout = None
+    for top, bottom in _runs(labeled.sum(1) >= 3 * min_tile):
+        height = bottom - top
+        tiles = [
+            (left, right)
+            for left, right in _runs(labeled[top:bottom].mean(0) > 0.5)
+            if right - left >= min_tile
+        ]
+        widths = [right - left for left, right in tiles]
+        gaps = [b[0] - a[1] for a, b in zip(tiles, tiles[1:])]
+        if (
+            len(tiles) != WORD_LENGTH
+            or max(widths) > 1.25 * min(widths)
+            or not 0.8 <= height / np.mean(widths) <= 1.25
+            or max(gaps) > 0.5 * min(widths)
+        ):
+            continue
+        centers = [(left + right) / 2 for left, right in tiles]
+        if layout is None:
+            layout = centers
+        elif max(abs(a - b) for a, b in zip(layout, centers)) > min(widths) / 2:
+            continue
+        pattern = []
+        for left, right in tiles:
+            tile = labels[top:bottom, left:right]
+            pattern.append(int(np.bincount(tile[tile >= 0], minlength=3).argmax()))
+        rows.append(tuple(pattern))
+    return rows
+
+
+def _runs(mask: np.ndarray) -> List[Tuple[int, int]]:
+    """(start, end) of every run of True values in a 1-D mask"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return list(zip(edges[::2], edges[1::2]))
@@ -1,15 +1,29 @@
+import concurrent.futures
+import contextvars
 import logging
 import textwrap
+import threading
+from collections import deque
 from typing import Dict, List, Tuple
 
+from gui_agents.s2_5.agents.action_parser import ParsedAction, parse_plan
 from gui_agents.s2_5.agents.grounding import ACI
+from gui_agents.s2_5.agents.reflection_scheduler import (
+    LOCAL_REFLECTION,
+    ReflectionScheduler,
+)
+from gui_agents.s2_5.agents.trajectory_summary import TrajectorySummarizer
+from gui_agents.s2_5.core.batching import batcher_stats
+from gui_agents.s2_5.core.context_budget import ContextBudget
 from gui_agents.s2_5.core.module import BaseModule
+from gui_agents.s2_5.core.retry import DeadlineExceeded, deadline
+from gui_agents.s2_5.core.screen_diff import ScreenChangeDetector
+from gui_agents.s2_5.core.telemetry import UsageTracker
 from gui_agents.s2_5.memory.procedural_memory import PROCEDURAL_MEMORY
 from gui_agents.s2_5.utils.common_utils import (
     call_llm_safe,
-    extract_first_agent_function,
-    parse_single_code_from_string,
-    sanitize_code,
+    grounded_action_complete,
+    reflection_case,
     split_thinking_response,
 )
 
@@ -48,6 +62,47 @@ class Worker(BaseModule):
         self.use_thinking = engine_params.get("model", "") in [
             "claude-3-7-sonnet-20250219", "claude-sonnet-4-202505141"
         ]
+        # Stream the generator response and stop once the grounded action code block closes
+        self.stream = engine_params.get("stream", False)
+        # Seconds all model calls of one step may take, retries included
+        self.step_budget = engine_params.get("step_budget")
+        # Skip model calls when the screen did not change since the previous step
+        self.skip_unchanged = engine_params.get("skip_unchanged_screens", False)
+        self.screen_change_threshold = engine_params.get(
+            "screen_change_threshold", 0.0002
+        )
+        self.max_skipped_steps = engine_params.get("max_skipped_steps", 2)
+        # Estimated input tokens the generator and reflection histories may hold
+        self.context_token_budget = engine_params.get("context_token_budget")
+        self.reflection_token_budget = engine_params.get(
+            "reflection_token_budget", self.context_token_budget
+        )
+        # Rolling summary: the reflection agent sees older turns only as a summary
+        self.reflection_summary = engine_params.get("reflection_summary", False)
+        self.summary_keep_turns = engine_params.get("summary_keep_turns", 3)
+        self.summary_fold_every = engine_params.get("summary_fold_every", 4)
+        self.summary_engine_params = engine_params.get("summary_engine_params")
+        # Actions the generator may chain in one plan, only the first one is grounded
+        self.max_actions_per_plan = engine_params.get("max_actions_per_plan", 1)
+        # Only call the reflection model when progress stalls (True or scheduler options)
+        self.reflection_schedule = engine_params.get("reflection_schedule")
+        # Send the generator request alongside the reflection, kept if it reports Case 2
+        self.speculative = engine_params.get("speculative_generation", False)
+        # Play Wordle guesses with a local solver, the models only handle surprises
+        # (True or solver options: word_list, opening, max_pool, tolerance, max_misses)
+        wordle_solver = engine_params.get("wordle_solver")
+        self.wordle_solver_options = None
+        if wordle_solver:
+            self.wordle_solver_options = (
+                wordle_solver if isinstance(wordle_solver, dict) else {}
+            )
+        self._speculation_pool = (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="speculation"
+            )
+            if self.speculative
+            else None
+        )
         self.reset()
 
     def reset(self):
@@ -57,46 +112,445 @@ class Worker(BaseModule):
             skipped_actions = []
 
         sys_prompt = PROCEDURAL_MEMORY.construct_simple_worker_procedural_memory(
-            type(self.grounding_agent), skipped_actions=skipped_actions
+            type(self.grounding_agent),
+            skipped_actions=skipped_actions,
+            max_actions=self.max_actions_per_plan,
         ).replace("CURRENT_OS", self.platform)
 
-        self.generator_agent = self._create_agent(sys_prompt)
+        self.generator_agent = self._create_agent(sys_prompt, role="generator")
         self.reflection_agent = self._create_agent(
-            PROCEDURAL_MEMORY.REFLECTION_ON_TRAJECTORY
+            PROCEDURAL_MEMORY.REFLECTION_ON_TRAJECTORY, role="reflection"
         )
 
+        # Without a summary model the rolling summary is filled in from a template
+        summary_agent = None
+        if self.reflection_summary and self.summary_engine_params:
+            summary_agent = self._create_agent(
+                PROCEDURAL_MEMORY.SUMMARIZE_TRAJECTORY,
+                engine_params=self.summary_engine_params,
+                role="summary",
+            )
+        self.trajectory_summarizer = TrajectorySummarizer(summary_agent)
+        self.reflection_system_prompt = None
+
+        # Speculative calls get their own engine instance, so they never share its
+        # per-call state (last_usage) with the real generator call
+        speculation_agent = None
+        if self.speculative:
+            speculation_agent = self._create_agent(sys_prompt, role="speculation")
+        self.speculation_agent = speculation_agent
+        self.speculation = None  # (future, cancel event) of the call in flight
+
+        # Per-call token, latency and cost records for every model the worker drives
+        self.usage_tracker = UsageTracker()
+        for lmm_agent in [
+            self.generator_agent,
+            self.reflection_agent,
+            summary_agent,
+            speculation_agent,
+            getattr(self.grounding_agent, "grounding_model", None),
+            getattr(self.grounding_agent, "text_span_agent", None),
+        ]:
+            if lmm_agent is not None:
+                lmm_agent.usage_tracker = self.usage_tracker
+
+        self.context_budgets = {}
+        for agent, budget in [
+            (self.generator_agent, self.context_token_budget),
+            (self.reflection_agent, self.reflection_token_budget),
+        ]:
+            if budget:
+                self.context_budgets[agent.role] = ContextBudget(
+                    budget,
+                    provider=agent.engine.provider,
+                    model=getattr(agent.engine, "model", None),
+                )
+        self.context_tokens = {}
+
+        self.speculation_stats = {"attempts": 0, "accepted": 0, "rejected": 0}
+        self.reflection_scheduler = None
+        if self.reflection_schedule:
+            options = (
+                self.reflection_schedule
+                if isinstance(self.reflection_schedule, dict)
+                else {}
+            )
+            self.reflection_scheduler = ReflectionScheduler(**options)
+        self.last_step_error = None
+
+        self.wordle_solver = self._create_wordle_solver()
+        self.pending_guess = None
+        self.solver_note = None
+        self.solver_stats = {"guesses": 0, "handoffs": 0, "misses": 0}
+
         self.turn_count = 0
         self.worker_history = []
         self.reflections = []
         self.cost_this_turn = 0
-        self.screenshot_inputs = []
+        # Handles into the image store, only the last max_trajectory_length are kept
+        self.screenshot_inputs = deque(maxlen=self.max_trajectory_length)
+        self.screen_detector = ScreenChangeDetector(self.screen_change_threshold)
+        self.last_plan_code = None
+        self.skipped_steps = 0
+
+    def _skip_step(self) -> Tuple[Dict, List]:
+        """Wait again without any model call, the screen has not changed yet"""
+        self.skipped_steps += 1
+        self.usage_tracker.record_skip("generator")
+        if self.enable_reflection:
+            self.usage_tracker.record_skip("reflection")
+        logger.info("Screen unchanged after waiting, skipping the model calls")
+        plan_code = "agent.wait(1.0)"
+        self.worker_history.append(
+            "The screen did not change, so the agent waited again without replanning."
+        )
+        step_usage = self.usage_tracker.summary(step=self.turn_count)
+        self.cost_this_turn = step_usage["cost"]
+        executor_info = {
+            "full_plan": "",
+            "executor_plan": "",
+            "plan_thoughts": "",
+            "plan_code": plan_code,
+            "reflection": None,
+            "reflection_thoughts": None,
+            "skipped": True,
+            "step_usage": step_usage,
+            "total_usage": self.usage_tracker.summary(),
+        }
+        self.turn_count += 1
+        return executor_info, [self.grounding_agent.wait(1.0)]
+
+    def _load_task(self, instruction: str, obs: Dict):
+        """Load the task into the system prompts and the initial screen for reflection"""
+        self.generator_agent.add_system_prompt(
+            self.generator_agent.system_prompt.replace("TASK_DESCRIPTION", instruction)
+        )
+        if self.enable_reflection:
+            text_content = textwrap.dedent(
+                f"""
+                Task Description: {instruction}
+                Current Trajectory below:
+                """
+            )
+            updated_sys_prompt = self.reflection_agent.system_prompt + "\n" + text_content
+            self.reflection_agent.add_system_prompt(updated_sys_prompt)
+            self.reflection_system_prompt = updated_sys_prompt
+            self.reflection_agent.add_message(
+                text_content="The initial screen is provided. No action has been taken yet.",
+                image_content=obs["screenshot"],
+                role="user",
+            )
+
+    def _create_wordle_solver(self):
+        if self.wordle_solver_options is None:
+            return None
+        from gui_agents.s2_5.agents.wordle_solver import (
+            WordleSolver,
+            find_word_list,
+            load_words,
+        )
+
+        options = self.wordle_solver_options
+        path = find_word_list(options.get("word_list"))
+        words = load_words(path) if path else ()
+        if not words:
+            logger.warning(
+                "No Wordle word list found (%s), the local solver is disabled",
+                options.get("word_list") or "no system dictionary",
+            )
+            return None
+        logger.info("Local Wordle solver loaded %d words from %s", len(words), path)
+        return WordleSolver(
+            words,
+            opening=options.get("opening"),
+            max_pool=options.get("max_pool", 1500),
+        )
+
+    def _solver_state(self) -> Tuple:
+        """What a step may change in the local solver, for rolling back a failed step"""
+        solver = self.wordle_solver
+        # update, discard and reset rebind the word lists, so they are not copied
+        lists = (
+            (solver.words, solver.candidates, list(solver.history), solver.opening)
+            if solver is not None
+            else None
+        )
+        return (
+            solver,
+            lists,
+            dict(self.solver_stats),
+            self.pending_guess,
+            self.solver_note,
+        )
+
+    def _restore_solver_state(self, state: Tuple):
+        solver, lists, stats, self.pending_guess, self.solver_note = state
+        self.wordle_solver = solver
+        if solver is not None:
+            solver.words, solver.candidates, solver.history, solver.opening = lists
+        self.solver_stats = stats
+
+    def _solver_step(self, obs: Dict):
+        """Play the next Wordle guess locally, None to hand the step to the models.
+
+        The board is read from the screenshot and the guess typed last step (by the
+        solver or the generator) is scored with the row it added. An empty board looks
+        the same as no board at all, so the solver only takes over once a scored row
+        shows the game is on screen; the opening is suggested to the generator. A
+        board that does not match the known guesses, an unscored guess (e.g. a word
+        the game rejects), a lost game or feedback no word fits are left to the models.
+        """
+        from gui_agents.s2_5.agents.wordle_solver import read_board
+
+        solver = self.wordle_solver
+        options = self.wordle_solver_options
+        rows = read_board(obs["screenshot"], tolerance=options.get("tolerance", 40.0))
+        pending, self.pending_guess = self.pending_guess, None
+        reason = None
+        if pending and len(rows) == len(solver.history) + 1:
+            solver.update(pending, rows[-1])
+        elif pending and not rows:
+            # Without a visible board the guess may never have reached the game
+            reason = f"no scored row is visible, the guess {pending} was not scored"
+        elif pending:
+            self.solver_stats["misses"] += 1
+            solver.discard(pending)
+            reason = f"the guess {pending} was not scored, it may have been rejected"
+            if self.solver_stats["misses"] >= options.get("max_misses", 3):
+                logger.warning("Local Wordle solver keeps missing, disabling it")
+                self.wordle_solver = None
+        # Once solved, the board may be hidden behind the game's result dialog
+        if reason is None and not solver.solved:
+            if not rows:
+                reason = "no scored row is visible yet"
+                if not solver.history and solver.candidates:
+                    reason += f", a good opening guess is {solver.next_guess()}"
+            elif len(rows) != len(solver.history):
+                reason = (
+                    f"the board shows {len(rows)} scored rows, "
+                    f"expected {len(solver.history)}"
+                )
+            elif len(rows) >= 6:
+                reason = "no guesses are left"
+            elif not solver.candidates:
+                reason = "no known word fits the feedback"
+        if reason is not None:
+            self.solver_stats["handoffs"] += 1
+            self.solver_note = (
+                f"Handing over to the model: {reason}. {solver.describe()}"
+            )
+            logger.info("Local Wordle solver: %s", self.solver_note)
+            return None
+
+        agent = self.grounding_agent
+        agent.coords1, agent.coords2 = None, None
+        if solver.solved:
+            plan_code = "agent.done()"
+            exec_code = agent.done()
+            note = f"The local solver found the word {solver.history[-1][0]}."
+        else:
+            guess = solver.next_guess()
+            self.pending_guess = guess
+            self.solver_stats["guesses"] += 1
+            plan_code = f"agent.type(text={guess.lower()!r}, enter=True)"
+            exec_code = agent.type(text=guess.lower(), enter=True)
+            note = f"The local solver typed the guess {guess}. {solver.describe()}"
+        logger.info("Local Wordle solver: %s", note)
+        # The turn enters both histories like a model turn, so a handover continues it
+        generator_message = (
+            ""
+            if self.turn_count > 0
+            else "The initial screen is provided. No action has been taken yet.\n"
+        )
+        self.generator_agent.add_message(
+            generator_message + f"Local Wordle solver: {note}",
+            image_content=obs["screenshot"],
+            role="user",
+        )
+        self.generator_agent.add_message(
+            f"(Next Action)\n{note}\n\n(Grounded Action)\n```python\n{plan_code}\n```",
+            role="assistant",
+        )
+        if self.enable_reflection and self.turn_count > 0:
+            self.reflection_agent.add_message(
+                text_content=self.worker_history[-1],
+                image_content=obs["screenshot"],
+                role="user",
+            )
+        self.worker_history.append(note)
+        self.last_plan_code = plan_code
+        self.usage_tracker.record_skip("generator")
+        if self.enable_reflection:
+            self.usage_tracker.record_skip("reflection")
+        step_usage = self.usage_tracker.summary(step=self.turn_count)
+        self.cost_this_turn = step_usage["cost"]
+        executor_info = {
+            "full_plan": "",
+            "executor_plan": note,
+            "plan_thoughts": "",
+            "plan_code": plan_code,
+            "reflection": None,
+            "reflection_thoughts": None,
+            "solver": dict(self.solver_stats),
+            "step_usage": step_usage,
+            "total_usage": self.usage_tracker.summary(),
+        }
+        self.turn_count += 1
+        self.screenshot_inputs.append(
+            self.generator_agent.image_store.put(obs["screenshot"])
+        )
+        self.flush_messages()
+        return executor_info, [exec_code]
+
+    def _start_speculation(self, message: str, screenshot):
+        """Send the generator request without the reflection while the reflection runs"""
+        self.generator_agent.add_message(message, image_content=screenshot, role="user")
+        messages = list(self.generator_agent.messages)
+        self.generator_agent.truncate_messages(len(messages) - 1)
+        self.speculation_stats["attempts"] += 1
+        cancel = threading.Event()
+        # The copied context carries the step deadline into the pool thread. The
+        # response is streamed (unless thinking is on) so it can be cancelled midway
+        future = self._speculation_pool.submit(
+            contextvars.copy_context().run,
+            call_llm_safe,
+            self.speculation_agent,
+            messages=messages,
+            temperature=self.temperature,
+            use_thinking=self.use_thinking,
+            stream=True,
+            stop_when=grounded_action_complete,
+            cancel=cancel,
+        )
+        self.speculation = (future, cancel)
+
+    def cancel_speculation(self):
+        """Stop the speculative call in flight, if any, without waiting for it"""
+        if self.speculation is None:
+            return
+        future, cancel = self.speculation
+        self.speculation = None
+        cancel.set()
+        future.cancel()
+
+    def _resolve_speculation(self, reflection):
+        """The speculative plan if the reflection says Case 2 and the call succeeded"""
+        future, _ = self.speculation
+        if reflection_case(reflection) != 2:
+            # Stop paying for a plan that will not be used
+            self.cancel_speculation()
+            self.speculation_stats["rejected"] += 1
+            return None
+        self.speculation = None
+        try:
+            full_plan = future.result()
+        except Exception as e:
+            logger.warning("Speculative generator call failed: %s", e)
+            self.speculation_stats["rejected"] += 1
+            return None
+        self.speculation_stats["accepted"] += 1
+        logger.info("Reflection reports Case 2, keeping the speculative plan")
+        return full_plan
+
+    def _action_sequence(self, actions: List[ParsedAction]) -> List[ParsedAction]:
+        """The prefix of actions that may run back-to-back after one grounding.
+
+        The sequence ends before any later action that needs coordinates (the screen
+        will have changed by then) and after done() or fail().
+        """
+        sequence = []
+        for action in actions:
+            if sequence and self.grounding_agent.grounding_targets(action):
+                break
+            sequence.append(action)
+            if action.name in ("done", "fail"):
+                break
+        if len(sequence) < len(actions):
+            logger.info(
+                "Running %d of the %d planned actions", len(sequence), len(actions)
+            )
+        return sequence
+
+    def _reflection_trigger(self, screen_changed: bool, obs: Dict):
+        """Why the reflection model is called this step, None to use LOCAL_REFLECTION"""
+        if self.reflection_scheduler is None:
+            return "every_step"
+        # Errors raised by the environment executing the last action, or by grounding it
+        action_error = obs.get("last_action_error") or self.last_step_error
+        self.last_step_error = None
+        return self.reflection_scheduler.trigger(screen_changed, action_error)
+
+    def speculation_summary(self) -> Dict:
+        stats = dict(self.speculation_stats)
+        stats["acceptance_rate"] = (
+            stats["accepted"] / stats["attempts"] if stats["attempts"] else 0.0
+        )
+        return stats
+
+    def fold_reflection_history(self):
+        """Replace the reflection agent's older turns with the rolling summary.
+
+        Turns are folded summary_fold_every at a time, once more than summary_keep_turns
+        have accumulated, so the prompt prefix only changes every few steps.
+        """
+        turns = len(self.reflection_agent.messages) - 1
+        if (
+            self.reflection_system_prompt is None
+            or turns < self.summary_keep_turns + self.summary_fold_every
+        ):
+            return
+        fold = turns - self.summary_keep_turns
+        summary = self.trajectory_summarizer.fold(
+            [
+                message["content"][0]["text"]
+                for message in self.reflection_agent.messages[1 : fold + 1]
+            ]
+        )
+        for _ in range(fold):
+            self.reflection_agent.remove_message_at(1)
+        self.reflection_agent.add_system_prompt(
+            f"{self.reflection_system_prompt}\nEarlier turns, summarized:\n{summary}\n\nMost recent turns below:\n"
+        )
 
     # Flushing strategy dependant on model context limits
     def flush_messages(self):
-        engine_type = self.engine_params.get("engine_type", "")
+        if self.reflection_summary:
+            self.fold_reflection_history()
+
+        # Ask the engine rather than engine_params so wrapped and replayed engines flush alike
+        engine_type = self.generator_agent.engine.provider
 
         # Flush strategy for long-context models: keep all text, only keep latest images
         if engine_type in ["anthropic", "openai", "gemini"]:
             max_images = self.max_trajectory_length
+            # Anthropic caches the message prefix, so evict images in batches: the prefix then
+            # only changes every few steps instead of on every step once the window is full
+            eviction_batch = (
+                max(1, max_images // 2) if engine_type == "anthropic" else 1
+            )
             for agent in [self.generator_agent, self.reflection_agent]:
-                # keep latest k images
-                img_count = 0
-                for i in range(len(agent.messages) - 1, -1, -1):
-                    for j in range(len(agent.messages[i]["content"])):
-                        if "image" in agent.messages[i]["content"][j].get("type", ""):
-                            img_count += 1
-                            if img_count > max_images:
-                                del agent.messages[i]["content"][j]
+                if agent.image_count <= max_images:
+                    continue
+                # keep latest k images, the oldest are evicted in O(1) each
+                keep_images = max_images - eviction_batch + 1
+                while agent.image_count > keep_images:
+                    agent.evict_oldest_image()
 
         # Flush strategy for non-long-context models: drop full turns
         else:
             # generator msgs are alternating [user, assistant], so 2 per round
             if len(self.generator_agent.messages) > 2 * self.max_trajectory_length + 1:
-                self.generator_agent.messages.pop(1)
-                self.generator_agent.messages.pop(1)
+                self.generator_agent.remove_message_at(1)
+                self.generator_agent.remove_message_at(1)
             # reflector msgs are all [(user text, user image)], so 1 per round
             if len(self.reflection_agent.messages) > self.max_trajectory_length + 1:
-                self.reflection_agent.messages.pop(1)
+                self.reflection_agent.remove_message_at(1)
+
+        # Then hold each history to its estimated token budget, if one is set
+        for agent in [self.generator_agent, self.reflection_agent]:
+            budget = self.context_budgets.get(agent.role)
+            if budget is not None:
+                self.context_tokens[agent.role] = budget.trim(agent)
 
     def generate_next_action(
         self,
@@ -105,73 +559,161 @@ class Worker(BaseModule):
     ) -> Tuple[Dict, List]:
         """
         Predict the next action(s) based on the current observation.
+
+        Raises DeadlineExceeded once the step (or game) budget is spent and other errors
+        when a model call fails for good. The step is then given up as a whole: nothing
+        it added to the trajectory is kept.
         """
+        generator_length = len(self.generator_agent.messages)
+        reflection_length = len(self.reflection_agent.messages)
+        history_length = len(self.worker_history)
+        reflections_length = len(self.reflections)
+        # Turn 0 loads the task into both system prompts
+        generator_prompt = self.generator_agent.system_prompt
+        reflection_prompt = self.reflection_agent.system_prompt
+        reflection_system_prompt = self.reflection_system_prompt
+        screen_state = (
+            self.screen_detector.last_signature,
+            self.screen_detector.last_difference,
+        )
+        step_state = (self.turn_count, self.last_plan_code, self.skipped_steps)
+        screenshot_inputs = list(self.screenshot_inputs)
+        solver_state = self._solver_state()
+        try:
+            with deadline(self.step_budget, "step"):
+                return self._generate_next_action(instruction, obs)
+        except Exception:
+            self.cancel_speculation()
+            self.generator_agent.truncate_messages(generator_length)
+            self.reflection_agent.truncate_messages(reflection_length)
+            del self.worker_history[history_length:]
+            del self.reflections[reflections_length:]
+            self.generator_agent.add_system_prompt(generator_prompt)
+            self.reflection_agent.add_system_prompt(reflection_prompt)
+            self.reflection_system_prompt = reflection_system_prompt
+            (
+                self.screen_detector.last_signature,
+                self.screen_detector.last_difference,
+            ) = screen_state
+            self.turn_count, self.last_plan_code, self.skipped_steps = step_state
+            self.screenshot_inputs.clear()
+            self.screenshot_inputs.extend(screenshot_inputs)
+            self._restore_solver_state(solver_state)
+            raise
+
+    def _generate_next_action(
+        self,
+        instruction: str,
+        obs: Dict,
+    ) -> Tuple[Dict, List]:
         agent = self.grounding_agent
+        self.usage_tracker.step = self.turn_count
+        screen_changed = True
+        if self.skip_unchanged or self.reflection_scheduler is not None:
+            screen_changed = (
+                self.screen_detector.changed(obs["screenshot"]) or self.turn_count == 0
+            )
+        screen_unchanged = self.skip_unchanged and not screen_changed
+        # Nothing happened while waiting: keep waiting instead of asking the models again
+        if (
+            screen_unchanged
+            and (self.last_plan_code or "").startswith("agent.wait")
+            and self.skipped_steps < self.max_skipped_steps
+        ):
+            return self._skip_step()
+        self.skipped_steps = 0
+        if self.turn_count == 0:
+            self._load_task(instruction, obs)
+        if self.wordle_solver is not None:
+            solved_locally = self._solver_step(obs)
+            if solved_locally is not None:
+                return solved_locally
+
         generator_message = (
             ""
             if self.turn_count > 0
             else "The initial screen is provided. No action has been taken yet."
         )
 
-        # Load the task into the system prompt
-        if self.turn_count == 0:
-            self.generator_agent.add_system_prompt(
-                self.generator_agent.system_prompt.replace(
-                    "TASK_DESCRIPTION", instruction
-                )
-            )
-
         # Get the per-step reflection
         reflection = None
         reflection_thoughts = None
+        text_buffer = f"\nCurrent Text Buffer = [{','.join(agent.notes)}]\n"
+        if self.solver_note:
+            text_buffer += f"Local Wordle solver: {self.solver_note}\n"
+            self.solver_note = None
         if self.enable_reflection:
-            # Load the initial message
-            if self.turn_count == 0:
-                text_content = textwrap.dedent(
-                    f"""
-                    Task Description: {instruction}
-                    Current Trajectory below:
-                    """
-                )
-                updated_sys_prompt = (
-                    self.reflection_agent.system_prompt + "\n" + text_content
-                )
-                self.reflection_agent.add_system_prompt(updated_sys_prompt)
-                self.reflection_agent.add_message(
-                    text_content="The initial screen is provided. No action has been taken yet.",
-                    image_content=obs["screenshot"],
-                    role="user",
-                )
-            # Load the latest action
-            else:
-                self.reflection_agent.add_message(
-                    text_content=self.worker_history[-1],
-                    image_content=obs["screenshot"],
-                    role="user",
-                )
-                full_reflection = call_llm_safe(
-                    self.reflection_agent,
-                    temperature=self.temperature,
-                    use_thinking=self.use_thinking,
-                )
-                reflection, reflection_thoughts = split_thinking_response(
-                    full_reflection
-                )
-                self.reflections.append(reflection)
-                generator_message += f"REFLECTION: You may use this reflection on the previous action and overall trajectory:\n{reflection}\n"
-                logger.info("REFLECTION: %s", reflection)
+            # The first turn has nothing to reflect on yet
+            if self.turn_count > 0:
+                trigger = self._reflection_trigger(screen_changed, obs)
+                # Nothing calls for a reflection: continue without the model
+                if trigger is None:
+                    # The turn stays in the trajectory the next model reflection sees
+                    self.reflection_agent.add_message(
+                        text_content=self.worker_history[-1],
+                        image_content=obs["screenshot"],
+                        role="user",
+                    )
+                    reflection = LOCAL_REFLECTION
+                    self.usage_tracker.record_skip("reflection")
+                    generator_message += f"REFLECTION: You may use this reflection on the previous action and overall trajectory:\n{reflection}\n"
+                # The last action had no visible effect, the last reflection still applies
+                elif screen_unchanged and self.reflections and trigger != "no_progress":
+                    self.reflection_agent.add_message(
+                        text_content=self.worker_history[-1],
+                        image_content=obs["screenshot"],
+                        role="user",
+                    )
+                    reflection = self.reflections[-1]
+                    self.usage_tracker.record_skip("reflection")
+                    generator_message += f"REFLECTION: The screen did not change after the previous action. Earlier reflection:\n{reflection}\n"
+                    logger.info("Screen unchanged, reusing the last reflection")
+                # Load the latest action
+                else:
+                    if trigger != "every_step":
+                        logger.info("Calling the reflection model: %s", trigger)
+                    self.reflection_agent.add_message(
+                        text_content=self.worker_history[-1],
+                        image_content=obs["screenshot"],
+                        role="user",
+                    )
+                    if self.speculative:
+                        self._start_speculation(
+                            generator_message + text_buffer, obs["screenshot"]
+                        )
+                    full_reflection = call_llm_safe(
+                        self.reflection_agent,
+                        temperature=self.temperature,
+                        use_thinking=self.use_thinking,
+                    )
+                    reflection, reflection_thoughts = split_thinking_response(
+                        full_reflection
+                    )
+                    self.reflections.append(reflection)
+                    generator_message += f"REFLECTION: You may use this reflection on the previous action and overall trajectory:\n{reflection}\n"
+                    logger.info("REFLECTION: %s", reflection)
+
+        full_plan = None
+        if self.speculation is not None:
+            full_plan = self._resolve_speculation(reflection)
+            if full_plan is not None:
+                # Record the message the kept plan was actually generated from
+                generator_message = ""
 
         # Add finalized message to conversation
-        generator_message += f"\nCurrent Text Buffer = [{','.join(agent.notes)}]\n"
+        generator_message += text_buffer
         self.generator_agent.add_message(
             generator_message, image_content=obs["screenshot"], role="user"
         )
 
-        full_plan = call_llm_safe(
-            self.generator_agent,
-            temperature=self.temperature,
-            use_thinking=self.use_thinking,
-        )
+        if full_plan is None:
+            full_plan = call_llm_safe(
+                self.generator_agent,
+                temperature=self.temperature,
+                use_thinking=self.use_thinking,
+                stream=self.stream,
+                stop_when=grounded_action_complete,
+            )
         plan, plan_thoughts = split_thinking_response(full_plan)
         # NOTE: currently dropping thinking tokens from context
         self.worker_history.append(plan)
@@ -180,16 +722,34 @@ class Worker(BaseModule):
 
         # Use the grounding agent to convert agent_action("desc") into agent_action([x, y])
         try:
-            agent.assign_coordinates(plan, obs)
-            plan_code = parse_single_code_from_string(plan.split("Grounded Action")[-1])
-            plan_code = sanitize_code(plan_code)
-            plan_code = extract_first_agent_function(plan_code)
-            exec_code = eval(plan_code)
+            # Parsed once, the same actions are grounded and turned into code
+            actions = parse_plan(plan, type(agent), limit=self.max_actions_per_plan)
+            actions = self._action_sequence(actions)
+            agent.assign_coordinates(actions[0], obs)
+            exec_codes = [actions[0](agent)]
+            # Later actions are never grounded, so they must not reuse the coordinates
+            for action in actions[1:]:
+                agent.coords1, agent.coords2 = None, None
+                exec_codes.append(action(agent))
+            plan_code = "\n".join(action.code for action in actions)
+            # Guesses the generator types are scored by the local solver next step
+            for action in actions:
+                text = str(action.get("text", ""))
+                if action.name == "type" and len(text) == 5 and text.isalpha():
+                    self.pending_guess = text.upper()
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error("Error in parsing plan code: %s", e)
+            self.last_step_error = e
             plan_code = "agent.wait(1.0)"
-            exec_code = eval(plan_code)
+            exec_codes = [agent.wait(1.0)]
+        self.last_plan_code = plan_code
+        if self.reflection_scheduler is not None:
+            self.reflection_scheduler.record_action(plan_code)
 
+        step_usage = self.usage_tracker.summary(step=self.turn_count)
+        self.cost_this_turn = step_usage["cost"]
         executor_info = {
             "full_plan": full_plan,
             "executor_plan": plan,
@@ -197,10 +757,31 @@ class Worker(BaseModule):
             "plan_code": plan_code,
             "reflection": reflection,
             "reflection_thoughts": reflection_thoughts,
+            "step_usage": step_usage,
+            "total_usage": self.usage_tracker.summary(),
         }
+        if hasattr(self.generator_agent.engine, "hedge_stats"):
+            executor_info["hedge_stats"] = self.generator_agent.engine.hedge_stats()
+        if hasattr(self.generator_agent.engine, "balancer_stats"):
+            executor_info["balancer_stats"] = self.generator_agent.engine.balancer_stats()
+        grounding_batches = batcher_stats()
+        if grounding_batches:
+            executor_info["batcher_stats"] = grounding_batches
         self.turn_count += 1
 
-        self.screenshot_inputs.append(obs["screenshot"])
+        self.screenshot_inputs.append(
+            self.generator_agent.image_store.put(obs["screenshot"])
+        )
         self.flush_messages()
+        if self.context_tokens:
+            executor_info["context_tokens"] = dict(self.context_tokens)
+        if self.speculative:
+            executor_info["speculation"] = self.speculation_summary()
+        if self.reflection_scheduler is not None:
+            executor_info["reflection_schedule"] = self.reflection_scheduler.summary()
+        if self.trajectory_summarizer.summary:
+            executor_info["trajectory_summary"] = self.trajectory_summarizer.summary
+        if self.wordle_solver_options is not None:
+            executor_info["solver"] = dict(self.solver_stats)
 
-        return executor_info, [exec_code]
+        return executor_info, exec_codes
@@ -98,8 +98,15 @@ def run_agent(agent, instruction: str, scaled_width: int, scaled_height: int):
         # Convert to base64 string.
         obs["screenshot"] = screenshot_bytes
 
-        # Get next action code from the agent
-        info, code = agent.predict(instruction=instruction, observation=obs)
+        # Get next action code from the agent. A step whose model calls failed for
+        # good (or ran out of time) is given up, the next one starts from a new screen
+        try:
+            info, code = agent.predict(instruction=instruction, observation=obs)
+        except Exception as e:
+            logger.error("Step failed: %s", e)
+            print("STEP FAILED:", e)
+            time.sleep(1.0)
+            continue
 
         if "done" in code[0].lower() or "fail" in code[0].lower():
             if platform.system() == "Darwin":
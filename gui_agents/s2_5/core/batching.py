@@ -0,0 +1,145 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+class RequestBatcher:
+    """Collects requests from concurrent callers and dispatches them in micro-batches.
+
+    Requests submitted within window seconds of the first queued one (up to
+    max_batch_size) are sent together on one background event loop, at most
+    max_concurrency at a time. A self-hosted server such as vLLM batches in-flight
+    requests on the GPU, so grouping them raises throughput as sessions are added.
+    """
+
+    def __init__(
+        self,
+        send: Callable,
+        window: float = 0.02,
+        max_batch_size: int = 16,
+        max_concurrency: int = 32,
+        name: str = "batcher",
+    ):
+        self.send = send
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "in_flight": 0,
+            "queue_wait": 0.0,
+        }
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.create_task(self._dispatch())
+        self._ready.set()
+        self._loop.run_forever()
+
+    def _update(self, **deltas):
+        with self._lock:
+            for key, delta in deltas.items():
+                self.metrics[key] += delta
+            self.metrics["max_queue_depth"] = max(
+                self.metrics["max_queue_depth"], self.metrics["queue_depth"]
+            )
+
+    def submit(self, request: Dict) -> concurrent.futures.Future:
+        """Queue one request, the returned future resolves to send(request)'s result"""
+        future = concurrent.futures.Future()
+        self._update(submitted=1, queue_depth=1)
+        self._loop.call_soon_threadsafe(
+            self._queue.put_nowait, (request, future, time.monotonic())
+        )
+        return future
+
+    async def _dispatch(self):
+        while True:
+            batch = [await self._queue.get()]
+            batch_ends = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = batch_ends - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            now = time.monotonic()
+            self._update(
+                batches=1,
+                queue_depth=-len(batch),
+                queue_wait=sum(now - queued for _, _, queued in batch),
+            )
+            with self._lock:
+                self.metrics["max_batch_size"] = max(
+                    self.metrics["max_batch_size"], len(batch)
+                )
+            for request, future, _ in batch:
+                self._loop.create_task(self._send_one(request, future))
+
+    async def _send_one(self, request, future):
+        async with self._semaphore:
+            if future.cancelled():
+                return
+            self._update(in_flight=1)
+            try:
+                result = await self.send(request)
+            except Exception as e:
+                self._update(in_flight=-1, failed=1)
+                if not future.cancelled():
+                    future.set_exception(e)
+                return
+            self._update(in_flight=-1, completed=1)
+            if not future.cancelled():
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        """Queue depth, in-flight requests and batch-size metrics"""
+        with self._lock:
+            stats = dict(self.metrics)
+        batches = stats["batches"]
+        dispatched = stats["submitted"] - stats["queue_depth"]
+        stats["mean_batch_size"] = dispatched / batches if batches else 0.0
+        stats["mean_queue_wait"] = (
+            stats.pop("queue_wait") / dispatched if dispatched else 0.0
+        )
+        return stats
+
+
+_BATCHERS: Dict[Tuple, RequestBatcher] = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+def get_batcher(key: Tuple, send: Callable, **options) -> RequestBatcher:
+    """Return the process-wide batcher for key, so every session shares one queue"""
+    with _BATCHERS_LOCK:
+        batcher = _BATCHERS.get(key)
+        if batcher is None:
+            batcher = RequestBatcher(send, name=f"batcher-{len(_BATCHERS)}", **options)
+            _BATCHERS[key] = batcher
+    return batcher
+
+
+def batcher_stats() -> Dict[str, Optional[Dict]]:
+    """Metrics of every batcher in this process"""
+    with _BATCHERS_LOCK:
+        batchers = list(_BATCHERS.items())
+    return {"/".join(str(part) for part in key): b.stats() for key, b in batchers}
@@ -0,0 +1,72 @@
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Takes a failing backend out of rotation.
+
+    After failure_threshold consecutive failures the breaker opens and rejects calls for
+    cooldown seconds. It then lets a single trial call through (half-open): a success
+    closes it again, a failure reopens it with the cooldown doubled up to max_cooldown.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        max_cooldown: float = 600.0,
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.time() - self.opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def available(self) -> bool:
+        """Whether a call may be sent now, without claiming the half-open trial"""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and not self.trial_running)
+
+    def allow(self) -> bool:
+        """Claim permission to send one call"""
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running:
+                # The trial call failed, back off for longer before the next one
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.opened_at = time.time()
+            elif self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = time.time()
+            self.trial_running = False
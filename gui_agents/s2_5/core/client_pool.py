@@ -0,0 +1,51 @@
+import asyncio
+import importlib
+import threading
+import weakref
+from typing import Dict, Tuple
+
+# One SDK client per (SDK, client class, connection settings), each holding its own
+# keep-alive connection pool. Async clients are bound to the event loop they run on.
+_CLIENTS: Dict[Tuple, object] = {}
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_LOCK = threading.Lock()
+
+
+def _client_key(sdk: str, client_class: str, client_kwargs: Dict) -> Tuple:
+    return (sdk, client_class) + tuple(
+        sorted((name, repr(value)) for name, value in client_kwargs.items())
+    )
+
+
+def get_client(sdk: str, client_class: str, client_kwargs: Dict):
+    """Return the process-wide client for these settings, creating it on first use.
+
+    Engines with the same provider, endpoint and API key get the same client and so
+    reuse its open connections instead of each paying for a new TLS handshake.
+    """
+    key = _client_key(sdk, client_class, client_kwargs)
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            cls = getattr(importlib.import_module(sdk), client_class)
+            client = _CLIENTS[key] = cls(**client_kwargs)
+    return client
+
+
+def get_async_client(sdk: str, client_class: str, client_kwargs: Dict):
+    """Async counterpart of get_client, shared within the running event loop"""
+    loop = asyncio.get_running_loop()
+    key = _client_key(sdk, client_class, client_kwargs)
+    with _LOCK:
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            cls = getattr(importlib.import_module(sdk), client_class)
+            client = clients[key] = cls(**client_kwargs)
+    return client
+
+
+def pool_size() -> int:
+    """Number of distinct synchronous clients (connection pools) created so far"""
+    with _LOCK:
+        return len(_CLIENTS)
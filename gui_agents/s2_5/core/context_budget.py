@@ -0,0 +1,190 @@
+import base64
+import functools
+import io
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from gui_agents.s2_5.core.image_processing import PROVIDER_PRESETS
+from gui_agents.s2_5.core.image_store import ImageRef
+
+logger = logging.getLogger("desktopenv.agent")
+
+# Fixed per-message overhead (role and separators) added by chat templates
+MESSAGE_OVERHEAD = 4
+# Characters per token when no tiktoken encoding can be loaded
+CHARS_PER_TOKEN = 4
+
+_encodings = {}
+_tiktoken_unavailable = False
+_encodings_lock = threading.Lock()
+_image_sizes = OrderedDict()  # ImageRef key -> (width, height)
+_image_sizes_lock = threading.Lock()
+
+
+def _encoding(model: Optional[str]):
+    """tiktoken encoding for model (o200k_base when unknown), None if unavailable"""
+    global _tiktoken_unavailable
+    with _encodings_lock:
+        if model in _encodings:
+            return _encodings[model]
+        if _tiktoken_unavailable:
+            return None
+        try:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(model or "")
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # tiktoken downloads its BPE files on first use, offline hosts fall back
+            logger.warning(
+                "No tiktoken encoding (%s), estimating %d characters per token",
+                e,
+                CHARS_PER_TOKEN,
+            )
+            _tiktoken_unavailable = True
+            return None
+        _encodings[model] = encoding
+        return encoding
+
+
+@functools.lru_cache(maxsize=4096)
+def text_tokens(text: str, model: Optional[str] = None) -> int:
+    """Estimated token count of text, exact for OpenAI models"""
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _image_size(payload) -> Optional[Tuple[int, int]]:
+    key = payload.key if isinstance(payload, ImageRef) else None
+    with _image_sizes_lock:
+        if key is not None and key in _image_sizes:
+            return _image_sizes[key]
+    if isinstance(payload, ImageRef):
+        data = payload.data()
+    elif isinstance(payload, str):
+        data = base64.b64decode(payload.split(",", 1)[-1])
+    else:
+        return None
+    from PIL import Image
+
+    try:
+        size = Image.open(io.BytesIO(data)).size
+    except Exception:
+        return None
+    if key is not None:
+        with _image_sizes_lock:
+            _image_sizes[key] = size
+            while len(_image_sizes) > 256:
+                _image_sizes.popitem(last=False)
+    return size
+
+
+def image_tokens(
+    width: int, height: int, provider: Optional[str], detail: str = "high"
+) -> int:
+    """Estimated tokens one image costs on provider, after its server-side resizing"""
+    if provider in ("openai", "azure", "open_router"):
+        if detail == "low":
+            return 85
+        # Fit in max_long x max_long, then scale the short side down to max_short
+        max_long, max_short, _ = PROVIDER_PRESETS["openai"]
+        scale = min(1.0, max_long / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, max_short / min(width, height))
+        tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+        return 85 + 170 * tiles
+    if provider == "anthropic":
+        max_long, _, max_pixels = PROVIDER_PRESETS["anthropic"]
+        scale = min(
+            1.0, max_long / max(width, height), (max_pixels / (width * height)) ** 0.5
+        )
+        return math.ceil(width * scale * height * scale / 750)
+    if provider == "gemini":
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+    # Self-hosted vision models (e.g. Qwen-VL through vLLM) use 28x28 pixel patches
+    return math.ceil(width * height / (28 * 28))
+
+
+class ContextBudget:
+    """Keeps an agent's message history under max_tokens estimated input tokens.
+
+    Text is counted with tiktoken, images with each provider's published formula.
+    Over budget, the oldest images are evicted first (their turns' text is kept), then
+    whole turns are dropped oldest first. The system prompt and the newest
+    min_messages messages are always kept.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        min_messages: int = 2,
+    ):
+        self.max_tokens = max_tokens
+        self.provider = provider
+        self.model = model
+        self.min_messages = min_messages
+
+    def part_tokens(self, part: Dict) -> int:
+        part_type = part.get("type", "")
+        if part_type == "text":
+            return text_tokens(part.get("text", ""), self.model)
+        if "image" in part_type:
+            if part_type == "image_url":
+                payload = part["image_url"]["url"]
+                detail = part["image_url"].get("detail", "high")
+            else:
+                payload, detail = part.get("source", {}).get("data"), "high"
+            size = _image_size(payload)
+            if size is None:
+                return 0
+            return image_tokens(*size, self.provider, detail)
+        return 0
+
+    def message_tokens(self, message: Dict) -> int:
+        content = message["content"]
+        if isinstance(content, str):
+            return MESSAGE_OVERHEAD + text_tokens(content, self.model)
+        return MESSAGE_OVERHEAD + sum(self.part_tokens(part) for part in content)
+
+    def count(self, messages) -> int:
+        """Estimated input tokens of a message list"""
+        return sum(self.message_tokens(message) for message in messages)
+
+    def trim(self, agent) -> int:
+        """Evict images, then drop turns, until agent.messages fit; returns the estimate"""
+        total = self.count(agent.messages)
+        newest = agent.messages[-self.min_messages :]
+        while total > self.max_tokens and agent.image_count:
+            message, part = agent.image_parts[0]
+            if any(message is kept for kept in newest):
+                break
+            total -= self.part_tokens(part)
+            agent.evict_oldest_image()
+        while total > self.max_tokens and len(agent.messages) > self.min_messages + 1:
+            total -= self.message_tokens(agent.messages[1])
+            agent.remove_message_at(1)
+            # Keep the history starting on a user turn
+            if (
+                agent.messages[1]["role"] == "assistant"
+                and len(agent.messages) > self.min_messages + 1
+            ):
+                total -= self.message_tokens(agent.messages[1])
+                agent.remove_message_at(1)
+        if total > self.max_tokens:
+            logger.warning(
+                "Context of %d estimated tokens exceeds the %d token budget",
+                total,
+                self.max_tokens,
+            )
+        return total
@@ -1,28 +1,258 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import gzip
+import hashlib
+import importlib
+import json
+import logging
 import os
+import queue
+import random
+import threading
+import time
+from collections import defaultdict, deque
 
-import backoff
-from anthropic import Anthropic
-from openai import (
-    AzureOpenAI,
-    APIConnectionError,
-    APIError,
-    AzureOpenAI,
-    OpenAI,
-    RateLimitError,
+from gui_agents.s2_5.core.batching import get_batcher
+from gui_agents.s2_5.core.circuit_breaker import CircuitBreaker
+from gui_agents.s2_5.core.client_pool import get_async_client, get_client
+from gui_agents.s2_5.core.retry import (
+    NO_RETRY,
+    RetryPolicy,
+    time_remaining,
+    with_retries,
 )
+from gui_agents.s2_5.core.rate_limiter import (
+    estimate_message_tokens,
+    get_rate_limiter,
+)
+from gui_agents.s2_5.utils.common_utils import fingerprint_request
+
+logger = logging.getLogger("desktopenv.agent")
+
+
+def _normalize_usage(usage):
+    """Token counts of a request as a plain dict, from an OpenAI- or Anthropic-style usage object"""
+    if usage is None or isinstance(usage, dict):
+        return usage
+    if getattr(usage, "prompt_tokens", None) is not None:
+        prompt_details = getattr(usage, "prompt_tokens_details", None)
+        completion_details = getattr(usage, "completion_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens,
+            "output_tokens": usage.completion_tokens or 0,
+            "cached_tokens": getattr(prompt_details, "cached_tokens", None) or 0,
+            "cache_write_tokens": 0,
+            "thinking_tokens": getattr(completion_details, "reasoning_tokens", None)
+            or 0,
+        }
+    # Anthropic reports cache reads and writes separately from uncached input
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return {
+        "input_tokens": (getattr(usage, "input_tokens", None) or 0)
+        + cache_read
+        + cache_write,
+        "output_tokens": getattr(usage, "output_tokens", None) or 0,
+        "cached_tokens": cache_read,
+        "cache_write_tokens": cache_write,
+        "thinking_tokens": 0,
+    }
+
+
+def _sdk(module_name, attr):
+    """Look up a class in a provider SDK, importing the SDK on first use"""
+    return getattr(importlib.import_module(module_name), attr)
+
+
+_EPHEMERAL = {"type": "ephemeral"}
 
 
 class LMMEngine:
-    pass
+    # Key under which engines share a rate limiter, matches the engine_type
+    provider = None
+    # Message layout LMMAgent.add_message builds for this engine: openai, anthropic or vllm
+    message_format = "openai"
+    rate_limit = -1
+    token_limit = -1
+    rate_limiter = None
+    # Normalized token usage of the most recent call and the number of retries so far
+    last_usage = None
+    retry_count = 0
+    # SDK module and client classes, clients come from the process-wide pool
+    sdk = "openai"
+    client_class = "OpenAI"
+    async_client_class = "AsyncOpenAI"
+    llm_client = None
+
+    # Retries happen in with_retries (core/retry.py) only, the SDKs' own are disabled
+    retry_policy = None
+
+    def _client_for_deadline(self, client):
+        # Cap the request timeout so a hung call cannot outlive the step or game budget
+        remaining, _ = time_remaining()
+        if remaining is None:
+            return client
+        return client.with_options(timeout=max(remaining, 1.0))
+
+    def _get_client(self):
+        if self.llm_client is None:
+            self.llm_client = get_client(
+                self.sdk, self.client_class, {**self._client_kwargs(), "max_retries": 0}
+            )
+        return self._client_for_deadline(self.llm_client)
+
+    def _get_async_client(self):
+        # Not kept on the engine, async clients belong to the running event loop
+        return self._client_for_deadline(
+            get_async_client(
+                self.sdk,
+                self.async_client_class,
+                {**self._client_kwargs(), "max_retries": 0},
+            )
+        )
+
+    def warm_up(self):
+        """Open a pooled connection to the provider before the first real request"""
+        try:
+            self._get_client().models.list()
+        except Exception as e:
+            logger.debug("Warm-up of %s failed: %s", self.provider, e)
+
+    def _get_rate_limiter(self):
+        if self.rate_limiter is None and (self.rate_limit > 0 or self.token_limit > 0):
+            client_kwargs = self._client_kwargs()
+            self.rate_limiter = get_rate_limiter(
+                self.provider,
+                api_key=client_kwargs.get("api_key"),
+                base_url=client_kwargs.get("base_url")
+                or client_kwargs.get("azure_endpoint"),
+                requests_per_minute=self.rate_limit,
+                tokens_per_minute=self.token_limit,
+            )
+        return self.rate_limiter
+
+    def _throttle(self, messages):
+        """Block until the shared limiter admits this request, returns the token estimate"""
+        limiter = self._get_rate_limiter()
+        if limiter is None:
+            return 0
+        estimate = estimate_message_tokens(messages)
+        limiter.acquire(tokens=estimate)
+        return estimate
+
+    async def _athrottle(self, messages):
+        limiter = self._get_rate_limiter()
+        if limiter is None:
+            return 0
+        estimate = estimate_message_tokens(messages)
+        await limiter.aacquire(tokens=estimate)
+        return estimate
+
+    def _record_usage(self, estimate, usage):
+        """Keep the usage of the call just made and settle it against the rate limiter"""
+        self.last_usage = _normalize_usage(usage)
+        if self.rate_limiter is not None and self.last_usage is not None:
+            self.rate_limiter.settle(
+                estimate,
+                self.last_usage["input_tokens"] + self.last_usage["output_tokens"],
+            )
+
+    @staticmethod
+    def _estimated_usage(messages, text):
+        # Streams cancelled early (or from providers without stream usage) report no counts
+        return {
+            "input_tokens": estimate_message_tokens(messages),
+            "output_tokens": len(text) // 4,
+            "cached_tokens": 0,
+            "cache_write_tokens": 0,
+            "thinking_tokens": 0,
+            "estimated": True,
+        }
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
+        """Arguments of a chat completion request, for OpenAI-compatible engines"""
+        raise NotImplementedError
+
+    def _record_completion(self, estimate, completion):
+        self._record_usage(estimate, completion.usage)
+
+    @with_retries
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        estimate = self._throttle(messages)
+        completion = self._get_client().chat.completions.create(
+            **self._request_kwargs(messages, temperature, max_new_tokens, **kwargs)
+        )
+        self._record_completion(estimate, completion)
+        return completion.choices[0].message.content
+
+    @with_retries
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        estimate = await self._athrottle(messages)
+        completion = await self._get_async_client().chat.completions.create(
+            **self._request_kwargs(messages, temperature, max_new_tokens, **kwargs)
+        )
+        self._record_completion(estimate, completion)
+        return completion.choices[0].message.content
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        """Yield the response text incrementally. Closing the generator cancels the request.
+
+        Engines that do not build chat completion requests (no _request_kwargs of
+        their own) yield the full response of generate as a single chunk.
+        """
+        if type(self)._request_kwargs is LMMEngine._request_kwargs:
+            return iter(
+                [
+                    self.generate(
+                        messages,
+                        temperature=temperature,
+                        max_new_tokens=max_new_tokens,
+                        **kwargs,
+                    )
+                ]
+            )
+        return self._chat_stream(messages, temperature, max_new_tokens, **kwargs)
+
+    @with_retries
+    def _chat_stream(self, messages, temperature, max_new_tokens, **kwargs):
+        estimate = self._throttle(messages)
+        stream = self._get_client().chat.completions.create(
+            stream=True,
+            # The last chunk then carries the real token usage
+            stream_options={"include_usage": True},
+            **self._request_kwargs(messages, temperature, max_new_tokens, **kwargs),
+        )
+        return self._iter_chat_stream(stream, messages, estimate)
+
+    def _iter_chat_stream(self, stream, messages, estimate):
+        """Yield text deltas from an OpenAI-style chat completion stream"""
+        text = ""
+        usage = None
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closing the response drops the connection, which stops generation server-side
+            stream.close()
+            self._record_usage(estimate, usage or self._estimated_usage(messages, text))
 
 
 class LMMEngineOpenAI(LMMEngine):
+    provider = "openai"
+
     def __init__(
         self,
         base_url=None,
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_limit=-1,
         temperature=None,
         organization=None,
         **kwargs,
@@ -32,43 +262,40 @@ class LMMEngineOpenAI(LMMEngine):
         self.base_url = base_url
         self.api_key = api_key
         self.organization = organization
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.temperature = temperature  # Can force temperature to be the same (in the case of o3 requiring temperature to be 1)
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("OPENAI_API_KEY")
         if api_key is None:
             raise ValueError(
                 "An API Key needs to be provided in either the api_key parameter or as an environment variable named OPENAI_API_KEY"
             )
         organization = self.organization or os.getenv("OPENAI_ORG_ID")
-        if not self.llm_client:
-            if not self.base_url:
-                self.llm_client = OpenAI(api_key=api_key, organization=organization)
-            else:
-                self.llm_client = OpenAI(
-                    base_url=self.base_url, api_key=api_key, organization=organization
-                )
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_completion_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=(
-                    temperature if self.temperature is None else self.temperature
-                ),
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        client_kwargs = {"api_key": api_key, "organization": organization}
+        if self.base_url:
+            client_kwargs["base_url"] = self.base_url
+        return client_kwargs
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_completion_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=(temperature if self.temperature is None else self.temperature),
+            **kwargs,
         )
 
 
 class LMMEngineAnthropic(LMMEngine):
+    provider = "anthropic"
+    message_format = "anthropic"
+    sdk = "anthropic"
+    client_class = "Anthropic"
+    async_client_class = "AsyncAnthropic"
+
     def __init__(
         self,
         base_url=None,
@@ -76,85 +303,199 @@ class LMMEngineAnthropic(LMMEngine):
         model=None,
         thinking=False,
         temperature=None,
+        rate_limit=-1,
+        token_limit=-1,
+        prompt_caching=True,
         **kwargs,
     ):
         assert model is not None, "model must be provided"
         self.model = model
         self.thinking = thinking
         self.api_key = api_key
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.temperature = temperature
+        # Cache reads and writes are reported per call as cached_tokens and
+        # cache_write_tokens in the usage records (see _normalize_usage)
+        self.prompt_caching = prompt_caching
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("ANTHROPIC_API_KEY")
         if api_key is None:
             raise ValueError(
                 "An API Key needs to be provided in either the api_key parameter or as an environment variable named ANTHROPIC_API_KEY"
             )
-        if not self.llm_client:
-            self.llm_client = Anthropic(api_key=api_key)
-        # Use the instance temperature if not specified in the call
-        temp = self.temperature if temperature is None else temperature
-        if self.thinking:
-            full_response = self.llm_client.messages.create(
-                system=messages[0]["content"][0]["text"],
+        return {"api_key": api_key}
+
+    def _system_and_turns(self, messages):
+        """Split off the system prompt and, with prompt caching on, mark cache breakpoints.
+
+        The system block is cached on its own. The newest message carries a breakpoint
+        that writes the whole trajectory prefix for the next step, and the previous user
+        turn carries one that reads what the last step wrote. Markers are set on copies
+        so the stored messages, and therefore the prefix bytes, never change.
+        """
+        system = messages[0]["content"][0]["text"]
+        turns = list(messages[1:])
+        if not self.prompt_caching:
+            return system, turns
+        system = [{"type": "text", "text": system, "cache_control": _EPHEMERAL}]
+        user_turns = [i for i, turn in enumerate(turns) if turn["role"] == "user"]
+        for i in {len(turns) - 1, *user_turns[-2:-1]}:
+            if i >= 0 and turns[i]["content"]:
+                content = list(turns[i]["content"])
+                content[-1] = {**content[-1], "cache_control": _EPHEMERAL}
+                turns[i] = {**turns[i], "content": content}
+        return system, turns
+
+    def _request_kwargs(
+        self, messages, temperature, max_new_tokens, thinking=False, **kwargs
+    ):
+        system, turns = self._system_and_turns(messages)
+        if thinking:
+            return dict(
+                system=system,
                 model=self.model,
-                messages=messages[1:],
+                messages=turns,
                 max_tokens=8192,
                 thinking={"type": "enabled", "budget_tokens": 4096},
                 **kwargs,
             )
-            thoughts = full_response.content[0].thinking
+        # Use the instance temperature if not specified in the call
+        temp = self.temperature if temperature is None else temperature
+        return dict(
+            system=system,
+            model=self.model,
+            messages=turns,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
+        )
+
+    @with_retries
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        estimate = self._throttle(messages)
+        full_response = self._get_client().messages.create(
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, thinking=self.thinking, **kwargs
+            )
+        )
+        self._record_usage(estimate, full_response.usage)
+        self._count_thinking(full_response)
+        if self.thinking:
             return full_response.content[1].text
-        return (
-            self.llm_client.messages.create(
-                system=messages[0]["content"][0]["text"],
-                model=self.model,
-                messages=messages[1:],
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
-                **kwargs,
+        return full_response.content[0].text
+
+    @with_retries
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        estimate = self._throttle(messages)
+        stream = self._get_client().messages.create(
+            stream=True,
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, thinking=self.thinking, **kwargs
+            ),
+        )
+        return self._iter_message_stream(stream, messages, estimate)
+
+    def _iter_message_stream(self, stream, messages, estimate):
+        """Yield answer text deltas from an Anthropic message event stream, skipping thinking deltas"""
+        text = ""
+        thinking = ""
+        usage = None
+        try:
+            for event in stream:
+                if event.type == "message_start":
+                    usage = _normalize_usage(event.message.usage)
+                elif event.type == "message_delta" and usage is not None:
+                    usage["output_tokens"] = event.usage.output_tokens
+                elif event.type == "content_block_delta":
+                    if event.delta.type == "thinking_delta":
+                        thinking += event.delta.thinking
+                    elif event.delta.type == "text_delta":
+                        text += event.delta.text
+                        yield event.delta.text
+        finally:
+            stream.close()
+            if usage is not None and not usage["output_tokens"]:
+                usage["output_tokens"] = (len(text) + len(thinking)) // 4
+            self._record_usage(estimate, usage or self._estimated_usage(messages, text))
+            self.last_usage["thinking_tokens"] = len(thinking) // 4
+
+    @with_retries
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        estimate = await self._athrottle(messages)
+        full_response = await self._get_async_client().messages.create(
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, thinking=self.thinking, **kwargs
             )
-            .content[0]
-            .text
         )
+        self._record_usage(estimate, full_response.usage)
+        self._count_thinking(full_response)
+        if self.thinking:
+            return full_response.content[1].text
+        return full_response.content[0].text
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
+    @with_retries
     # Compatible with Claude-3.7 Sonnet thinking mode
     def generate_with_thinking(
         self, messages, temperature=0.0, max_new_tokens=None, **kwargs
     ):
         """Generate the next message based on previous messages, and keeps the thinking tokens"""
 
-        full_response = self.llm_client.messages.create(
-            system=messages[0]["content"][0]["text"],
-            model=self.model,
-            messages=messages[1:],
-            max_tokens=8192,
-            thinking={"type": "enabled", "budget_tokens": 4096},
-            **kwargs,
+        estimate = self._throttle(messages)
+        full_response = self._get_client().messages.create(
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, thinking=True, **kwargs
+            )
+        )
+        self._record_usage(estimate, full_response.usage)
+        self._count_thinking(full_response)
+        return self._format_thinking_response(full_response)
+
+    @with_retries
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        """Async counterpart of generate_with_thinking"""
+
+        estimate = await self._athrottle(messages)
+        full_response = await self._get_async_client().messages.create(
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, thinking=True, **kwargs
+            )
         )
+        self._record_usage(estimate, full_response.usage)
+        self._count_thinking(full_response)
+        return self._format_thinking_response(full_response)
+
+    def _count_thinking(self, full_response):
+        # Thinking tokens are billed as output but not reported separately, estimate them
+        thoughts = [
+            block.thinking
+            for block in full_response.content
+            if getattr(block, "type", None) == "thinking"
+        ]
+        if self.last_usage is not None:
+            self.last_usage["thinking_tokens"] = sum(len(t) for t in thoughts) // 4
 
+    @staticmethod
+    def _format_thinking_response(full_response):
         thoughts = full_response.content[0].thinking
         answer = full_response.content[1].text
-        full_response = (
-            f"<thoughts>\n{thoughts}\n</thoughts>\n\n<answer>\n{answer}\n</answer>\n"
-        )
-        return full_response
+        return f"<thoughts>\n{thoughts}\n</thoughts>\n\n<answer>\n{answer}\n</answer>\n"
 
 
 class LMMEngineGemini(LMMEngine):
+    provider = "gemini"
+
     def __init__(
         self,
         base_url=None,
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -162,14 +503,12 @@ class LMMEngineGemini(LMMEngine):
         self.model = model
         self.base_url = base_url
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("GEMINI_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -180,30 +519,30 @@ class LMMEngineGemini(LMMEngine):
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named GEMINI_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"base_url": base_url, "api_key": api_key}
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
         # Use the temperature passed to generate, otherwise use the instance's temperature, otherwise default to 0.0
         temp = self.temperature if temperature is None else temperature
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
         )
 
 
 class LMMEngineOpenRouter(LMMEngine):
+    provider = "open_router"
+
     def __init__(
         self,
         base_url=None,
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -211,14 +550,12 @@ class LMMEngineOpenRouter(LMMEngine):
         self.model = model
         self.base_url = base_url
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("OPENROUTER_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -229,24 +566,25 @@ class LMMEngineOpenRouter(LMMEngine):
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named OPEN_ROUTER_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"base_url": base_url, "api_key": api_key}
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temp,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temp,
+            **kwargs,
         )
 
 
 class LMMEngineAzureOpenAI(LMMEngine):
+    provider = "azure"
+    client_class = "AzureOpenAI"
+    async_client_class = "AsyncAzureOpenAI"
+
     def __init__(
         self,
         base_url=None,
@@ -255,6 +593,7 @@ class LMMEngineAzureOpenAI(LMMEngine):
         model=None,
         api_version=None,
         rate_limit=-1,
+        token_limit=-1,
         temperature=None,
         **kwargs,
     ):
@@ -263,15 +602,13 @@ class LMMEngineAzureOpenAI(LMMEngine):
         self.api_version = api_version
         self.api_key = api_key
         self.azure_endpoint = azure_endpoint
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.cost = 0.0
         self.temperature = temperature
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("AZURE_OPENAI_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -287,56 +624,64 @@ class LMMEngineAzureOpenAI(LMMEngine):
             raise ValueError(
                 "An Azure API endpoint needs to be provided in either the azure_endpoint parameter or as an environment variable named AZURE_OPENAI_ENDPOINT"
             )
-        if not self.llm_client:
-            self.llm_client = AzureOpenAI(
-                azure_endpoint=azure_endpoint,
-                api_key=api_key,
-                api_version=api_version,
-            )
+        return {
+            "azure_endpoint": azure_endpoint,
+            "api_key": api_key,
+            "api_version": api_version,
+        }
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        completion = self.llm_client.chat.completions.create(
+        return dict(
             model=self.model,
             messages=messages,
             max_tokens=max_new_tokens if max_new_tokens else 4096,
             temperature=temp,
             **kwargs,
         )
+
+    def _record_completion(self, estimate, completion):
+        super()._record_completion(estimate, completion)
         total_tokens = completion.usage.total_tokens
         self.cost += 0.02 * ((total_tokens + 500) / 1000)
-        return completion.choices[0].message.content
 
 
 class LMMEnginevLLM(LMMEngine):
+    provider = "vllm"
+    message_format = "vllm"
+
     def __init__(
         self,
         base_url=None,
         api_key=None,
         model=None,
         rate_limit=-1,
+        token_limit=-1,
         temperature=None,
+        batching=False,
+        batch_window=0.02,
+        batch_max_size=16,
+        batch_concurrency=32,
         **kwargs,
     ):
         assert model is not None, "model must be provided"
         self.model = model
         self.api_key = api_key
         self.base_url = base_url
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
         self.temperature = temperature
+        # Share one micro-batching queue with every session using this endpoint and model
+        self.batching = batching
+        self.batch_options = dict(
+            window=batch_window,
+            max_batch_size=batch_max_size,
+            max_concurrency=batch_concurrency,
+        )
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(
-        self,
-        messages,
-        temperature=0.0,
-        top_p=0.8,
-        repetition_penalty=1.05,
-        max_new_tokens=512,
-        **kwargs,
-    ):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("vLLM_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -347,11 +692,14 @@ class LMMEnginevLLM(LMMEngine):
             raise ValueError(
                 "An endpoint URL needs to be provided in either the endpoint_url parameter or as an environment variable named vLLM_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
+        return {"base_url": base_url, "api_key": api_key}
+
+    def _request_kwargs(
+        self, messages, temperature, max_new_tokens, top_p, repetition_penalty
+    ):
         # Use self.temperature if set, otherwise use the temperature argument
         temp = self.temperature if self.temperature is not None else temperature
-        completion = self.llm_client.chat.completions.create(
+        return dict(
             model=self.model,
             messages=messages,
             max_tokens=max_new_tokens if max_new_tokens else 4096,
@@ -359,20 +707,106 @@ class LMMEnginevLLM(LMMEngine):
             top_p=top_p,
             extra_body={"repetition_penalty": repetition_penalty},
         )
+
+    def _get_batcher(self):
+        client_kwargs = {**self._client_kwargs(), "max_retries": 0}
+
+        async def send(request):
+            client = get_async_client("openai", "AsyncOpenAI", client_kwargs)
+            return await client.chat.completions.create(**request)
+
+        digest = hashlib.sha256(client_kwargs["api_key"].encode("utf-8")).hexdigest()
+        return get_batcher(
+            (client_kwargs["base_url"], self.model, digest[:8]),
+            send,
+            **self.batch_options,
+        )
+
+    def _batched_request(self, request):
+        # The batcher runs on its own thread, so the deadline is passed as a timeout
+        remaining, _ = time_remaining()
+        if remaining is not None:
+            request["timeout"] = max(remaining, 1.0)
+        return self._get_batcher().submit(request)
+
+    @with_retries
+    def generate(
+        self,
+        messages,
+        temperature=0.0,
+        top_p=0.8,
+        repetition_penalty=1.05,
+        max_new_tokens=512,
+        **kwargs,
+    ):
+        estimate = self._throttle(messages)
+        request = self._request_kwargs(
+            messages, temperature, max_new_tokens, top_p, repetition_penalty
+        )
+        if self.batching:
+            completion = self._batched_request(request).result()
+        else:
+            completion = self._get_client().chat.completions.create(**request)
+        self._record_usage(estimate, completion.usage)
+        return completion.choices[0].message.content
+
+    @with_retries
+    def generate_stream(
+        self,
+        messages,
+        temperature=0.0,
+        top_p=0.8,
+        repetition_penalty=1.05,
+        max_new_tokens=512,
+        **kwargs,
+    ):
+        estimate = self._throttle(messages)
+        stream = self._get_client().chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},
+            **self._request_kwargs(
+                messages, temperature, max_new_tokens, top_p, repetition_penalty
+            ),
+        )
+        return self._iter_chat_stream(stream, messages, estimate)
+
+    @with_retries
+    async def agenerate(
+        self,
+        messages,
+        temperature=0.0,
+        top_p=0.8,
+        repetition_penalty=1.05,
+        max_new_tokens=512,
+        **kwargs,
+    ):
+        estimate = await self._athrottle(messages)
+        request = self._request_kwargs(
+            messages, temperature, max_new_tokens, top_p, repetition_penalty
+        )
+        if self.batching:
+            completion = await asyncio.wrap_future(self._batched_request(request))
+        else:
+            completion = await self._get_async_client().chat.completions.create(
+                **request
+            )
+        self._record_usage(estimate, completion.usage)
         return completion.choices[0].message.content
 
 
 class LMMEngineHuggingFace(LMMEngine):
-    def __init__(self, base_url=None, api_key=None, rate_limit=-1, **kwargs):
+    provider = "huggingface"
+
+    def __init__(
+        self, base_url=None, api_key=None, rate_limit=-1, token_limit=-1, **kwargs
+    ):
         self.base_url = base_url
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("HF_TOKEN")
         if api_key is None:
             raise ValueError(
@@ -383,36 +817,39 @@ class LMMEngineHuggingFace(LMMEngine):
             raise ValueError(
                 "HuggingFace endpoint must be provided as base_url parameter or as an environment variable named HF_ENDPOINT_URL."
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(base_url=base_url, api_key=api_key)
-        return (
-            self.llm_client.chat.completions.create(
-                model="tgi",
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
-                temperature=temperature,
-                **kwargs,
-            )
-            .choices[0]
-            .message.content
+        return {"base_url": base_url, "api_key": api_key}
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
+        return dict(
+            model="tgi",
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temperature,
+            **kwargs,
         )
 
 
 class LMMEngineParasail(LMMEngine):
+    provider = "parasail"
+
     def __init__(
-        self, base_url=None, api_key=None, model=None, rate_limit=-1, **kwargs
+        self,
+        base_url=None,
+        api_key=None,
+        model=None,
+        rate_limit=-1,
+        token_limit=-1,
+        **kwargs,
     ):
         assert model is not None, "Parasail model id must be provided"
         self.base_url = base_url
         self.model = model
         self.api_key = api_key
-        self.request_interval = 0 if rate_limit == -1 else 60.0 / rate_limit
+        self.rate_limit = rate_limit
+        self.token_limit = token_limit
         self.llm_client = None
 
-    @backoff.on_exception(
-        backoff.expo, (APIConnectionError, APIError, RateLimitError), max_time=60
-    )
-    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+    def _client_kwargs(self):
         api_key = self.api_key or os.getenv("PARASAIL_API_KEY")
         if api_key is None:
             raise ValueError(
@@ -423,19 +860,980 @@ class LMMEngineParasail(LMMEngine):
             raise ValueError(
                 "Parasail endpoint must be provided as base_url parameter or as an environment variable named PARASAIL_ENDPOINT_URL"
             )
-        if not self.llm_client:
-            self.llm_client = OpenAI(
-                base_url=base_url if base_url else "https://api.parasail.io/v1",
-                api_key=api_key,
+        return {
+            "base_url": base_url if base_url else "https://api.parasail.io/v1",
+            "api_key": api_key,
+        }
+
+    def _request_kwargs(self, messages, temperature, max_new_tokens, **kwargs):
+        return dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_new_tokens if max_new_tokens else 4096,
+            temperature=temperature,
+            **kwargs,
+        )
+
+
+def _open_log(log_path, mode):
+    if log_path.endswith(".gz"):
+        return gzip.open(log_path, mode + "t", encoding="utf-8")
+    return open(log_path, mode, encoding="utf-8")
+
+
+def _replay_fingerprint(messages, temperature, max_new_tokens, thinking, kwargs):
+    return fingerprint_request(
+        messages,
+        temperature=temperature,
+        max_new_tokens=max_new_tokens,
+        thinking=thinking,
+        **kwargs,
+    )
+
+
+class _RequestLog:
+    """Append-only JSON-lines log of recorded requests, shared by all recorders of one path"""
+
+    _logs = {}
+    _logs_lock = threading.Lock()
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._has_header = os.path.exists(log_path) and os.path.getsize(log_path) > 0
+
+    @classmethod
+    def get(cls, log_path):
+        with cls._logs_lock:
+            if log_path not in cls._logs:
+                cls._logs[log_path] = cls(log_path)
+            return cls._logs[log_path]
+
+    def write(self, record, header):
+        with self._lock:
+            with _open_log(self.log_path, "a") as f:
+                if not self._has_header:
+                    f.write(json.dumps({"header": header}) + "\n")
+                    self._has_header = True
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+class LMMEngineRecorder(LMMEngine):
+    """Wraps any engine and logs each request fingerprint with its response and timings.
+
+    The log is JSON lines (gzip-compressed when log_path ends in .gz) and can be played
+    back offline with LMMEngineReplay. Images are only stored as digests.
+    """
+
+    def __init__(self, engine, log_path):
+        self.engine = engine
+        self.log_path = log_path
+        self.provider = engine.provider
+        self.message_format = engine.message_format
+        self.model = getattr(engine, "model", None)
+        self.temperature = getattr(engine, "temperature", None)
+        self._log = _RequestLog.get(log_path)
+
+    @property
+    def last_usage(self):
+        return self.engine.last_usage
+
+    @property
+    def retry_count(self):
+        return self.engine.retry_count
+
+    def warm_up(self):
+        self.engine.warm_up()
+
+    def _record(self, fingerprint, response, started, ttft=None):
+        self._log.write(
+            {
+                "fp": fingerprint,
+                "response": response,
+                "latency": round(time.time() - started, 4),
+                "ttft": None if ttft is None else round(ttft, 4),
+            },
+            header={
+                "engine": type(self.engine).__name__,
+                "provider": self.provider,
+                "message_format": self.message_format,
+                "model": self.model,
+            },
+        )
+
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, False, kwargs
+        )
+        started = time.time()
+        response = self.engine.generate(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        self._record(fingerprint, response, started)
+        return response
+
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, False, kwargs
+        )
+        started = time.time()
+        response = await self.engine.agenerate(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        self._record(fingerprint, response, started)
+        return response
+
+    def generate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, True, kwargs
+        )
+        started = time.time()
+        response = self.engine.generate_with_thinking(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        self._record(fingerprint, response, started)
+        return response
+
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, True, kwargs
+        )
+        started = time.time()
+        response = await self.engine.agenerate_with_thinking(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        self._record(fingerprint, response, started)
+        return response
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, False, kwargs
+        )
+        started = time.time()
+        chunks = self.engine.generate_stream(
+            messages, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs
+        )
+        response = ""
+        ttft = None
+        try:
+            for chunk in chunks:
+                if ttft is None:
+                    ttft = time.time() - started
+                response += chunk
+                yield chunk
+        finally:
+            chunks.close()
+            # Early-stopped streams are recorded as received, which is what replay returns
+            self._record(fingerprint, response, started, ttft)
+
+
+class ReplayMissError(KeyError):
+    """Raised when a replayed request was never recorded"""
+
+
+class LMMEngineReplay(LMMEngine):
+    """Plays back a log written by LMMEngineRecorder without any network access.
+
+    Responses are matched on the request fingerprint and returned in recorded order.
+    With realtime=True each call sleeps for its recorded latency, otherwise responses
+    are returned immediately.
+    """
+
+    provider = "replay"
+
+    def __init__(self, log_path=None, realtime=False, message_format=None, **kwargs):
+        assert log_path is not None, "log_path must be provided"
+        self.log_path = log_path
+        self.realtime = realtime
+        self.records = defaultdict(deque)
+        self._last = {}
+        self._lock = threading.Lock()
+        header = {}
+        with _open_log(log_path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "header" in record:
+                    header = header or record["header"]
+                    continue
+                self.records[record["fp"]].append(record)
+        # Mirror the recorded engine so agents build byte-identical messages
+        self.provider = header.get("provider", self.provider)
+        self.message_format = message_format or header.get(
+            "message_format", self.message_format
+        )
+        self.model = header.get("model")
+        self.temperature = None
+
+    def warm_up(self):
+        pass
+
+    def _lookup(self, messages, temperature, max_new_tokens, thinking, kwargs):
+        fingerprint = _replay_fingerprint(
+            messages, temperature, max_new_tokens, thinking, kwargs
+        )
+        with self._lock:
+            queue = self.records.get(fingerprint)
+            if queue:
+                self._last[fingerprint] = queue.popleft()
+            record = self._last.get(fingerprint)
+        if record is None:
+            raise ReplayMissError(
+                f"No recorded response for request {fingerprint[:12]} in {self.log_path}"
             )
-        return (
-            self.llm_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=max_new_tokens if max_new_tokens else 4096,
+        return record
+
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        record = self._lookup(messages, temperature, max_new_tokens, False, kwargs)
+        if self.realtime:
+            time.sleep(record["latency"])
+        return record["response"]
+
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        record = self._lookup(messages, temperature, max_new_tokens, False, kwargs)
+        if self.realtime:
+            await asyncio.sleep(record["latency"])
+        return record["response"]
+
+    def generate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        record = self._lookup(messages, temperature, max_new_tokens, True, kwargs)
+        if self.realtime:
+            time.sleep(record["latency"])
+        return record["response"]
+
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        record = self._lookup(messages, temperature, max_new_tokens, True, kwargs)
+        if self.realtime:
+            await asyncio.sleep(record["latency"])
+        return record["response"]
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        record = self._lookup(messages, temperature, max_new_tokens, False, kwargs)
+        if self.realtime:
+            time.sleep(record["ttft"] or record["latency"])
+        yield record["response"]
+        if self.realtime and record["ttft"] is not None:
+            time.sleep(max(0.0, record["latency"] - record["ttft"]))
+
+
+def _convert_part(part, target_format):
+    """Convert one image content part to the layout of target_format"""
+    if part.get("type") == "image":
+        source = part["source"]
+        media_type, data = source.get("media_type", "image/png"), source["data"]
+    elif part.get("type") == "image_url":
+        url = part["image_url"]["url"]
+        if not url.startswith("data:"):
+            return part
+        header, _, data = url.partition(",")
+        media_type = header[len("data:") :].split(";")[0]
+        if "/" not in media_type:
+            media_type = "image/png"
+    else:
+        return part
+
+    if target_format == "anthropic":
+        return {
+            "type": "image",
+            "source": {"type": "base64", "media_type": media_type, "data": data},
+        }
+    if target_format == "vllm":
+        return {"type": "image_url", "image_url": {"url": f"data:image;base64,{data}"}}
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{media_type};base64,{data}",
+            "detail": part.get("image_url", {}).get("detail", "high"),
+        },
+    }
+
+
+def convert_messages(messages, target_format):
+    """Translate messages built by LMMAgent.add_message into another message format.
+
+    Only image parts differ between the openai, anthropic and vllm layouts. Messages
+    that need no change are returned as they are, not copied.
+    """
+    converted = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            converted.append(message)
+            continue
+        parts = [_convert_part(part, target_format) for part in content]
+        if all(new is old for new, old in zip(parts, content)):
+            converted.append(message)
+        else:
+            converted.append({**message, "content": parts})
+    return converted
+
+
+def _disable_retries(engine):
+    """Make an engine (and the engine a recorder wraps) raise on its first error"""
+    engine.retry_policy = NO_RETRY
+    if isinstance(engine, LMMEngineRecorder):
+        _disable_retries(engine.engine)
+
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile of a non-empty sequence"""
+    ordered = sorted(values)
+    rank = max(
+        0, min(len(ordered) - 1, int(round(percentile / 100 * len(ordered))) - 1)
+    )
+    return ordered[rank]
+
+
+class _CompositeEngine(LMMEngine):
+    """Base of the engines that pass each request on to one of several backends.
+
+    Backends raise on their first error so the composite engine can fail over at
+    once. Retries happen only at this level, and retry_count adds up the retries
+    made here and by every backend.
+    """
+
+    engines = ()
+    own_retries = 0
+
+    @staticmethod
+    def _backend(engine):
+        """engine, built from its engine_params if needed, failing on its first error"""
+        if not isinstance(engine, LMMEngine):
+            engine = create_engine(engine)
+        _disable_retries(engine)
+        return engine
+
+    @property
+    def retry_count(self):
+        return self.own_retries + sum(engine.retry_count for engine in self.engines)
+
+    @retry_count.setter
+    def retry_count(self, value):
+        # with_retries counts the retries made at this level
+        self.own_retries += value - self.retry_count
+
+    def warm_up(self):
+        for engine in self.engines:
+            engine.warm_up()
+
+
+class LMMEngineHedged(_CompositeEngine):
+    """Sends each request to a primary engine and hedges slow calls to the next ones.
+
+    If the primary has not answered within hedge_percentile of its recent latencies
+    (hedge_delay seconds until hedge_min_samples calls were seen), the same request is
+    sent to the next engine, and so on. The first answer wins and the other calls are
+    cancelled: synchronous calls race streams and close the losing ones, async calls
+    cancel the losing tasks. A failed call hands over to the next engine right away.
+    """
+
+    provider = "hedged"
+
+    def __init__(
+        self,
+        engines=None,
+        hedge_percentile=95,
+        hedge_delay=10.0,
+        hedge_min_samples=5,
+        latency_window=50,
+        message_format=None,
+        **kwargs,
+    ):
+        assert engines and len(engines) >= 2, "engines must list at least two backends"
+        self.engines = [self._backend(engine) for engine in engines]
+        primary = self.engines[0]
+        self.provider = primary.provider
+        # Messages are built in one format and converted for each backend
+        self.message_format = message_format or primary.message_format
+        self.model = getattr(primary, "model", None)
+        self.temperature = None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = [deque(maxlen=latency_window) for _ in self.engines]
+        self.stats = {
+            "requests": 0,
+            "hedged": 0,
+            "errors": 0,
+            "wins": [0] * len(self.engines),
+        }
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4 * len(self.engines), thread_name_prefix="hedge"
+        )
+
+    def _delay(self):
+        """Seconds to wait for the primary before hedging"""
+        with self._lock:
+            samples = list(self.latencies[0])
+        if len(samples) < self.hedge_min_samples:
+            return self.hedge_delay
+        return _percentile(samples, self.hedge_percentile)
+
+    def _won(self, index, latency, hedged):
+        engine = self.engines[index]
+        with self._lock:
+            self.latencies[index].append(latency)
+            self.stats["wins"][index] += 1
+            self.stats["hedged"] += hedged
+        self.last_usage = engine.last_usage
+        self.model = getattr(engine, "model", None)
+
+    def hedge_stats(self):
+        """Request count, hedge rate and how often each backend answered first"""
+        delay = self._delay()
+        with self._lock:
+            requests = self.stats["requests"]
+            names = [
+                f"{i}:{engine.provider}/{getattr(engine, 'model', None)}"
+                for i, engine in enumerate(self.engines)
+            ]
+            return {
+                "requests": requests,
+                "hedged": self.stats["hedged"],
+                "hedge_rate": self.stats["hedged"] / requests if requests else 0.0,
+                "errors": self.stats["errors"],
+                "wins": dict(zip(names, self.stats["wins"])),
+                "hedge_wins": sum(self.stats["wins"][1:]),
+                "primary_p50": (
+                    _percentile(self.latencies[0], 50) if self.latencies[0] else None
+                ),
+                "hedge_delay": delay,
+            }
+
+    @staticmethod
+    def _run(chunks, index, results, cancelled):
+        # Racer thread: forward chunks until cancelled, closing the stream drops the request
+        try:
+            try:
+                for chunk in chunks:
+                    if cancelled.is_set():
+                        return
+                    results.put((index, "chunk", chunk))
+            finally:
+                chunks.close()
+            results.put((index, "done", None))
+        except Exception as e:
+            results.put((index, "error", e))
+
+    def _race(self, start):
+        """Yield the chunks of whichever engine answers first.
+
+        start(engine) returns an iterator of chunks for one engine, it runs on a worker
+        thread so the racers send their requests concurrently.
+        """
+        results = queue.Queue()
+        cancelled = [threading.Event() for _ in self.engines]
+        started = []
+        failed = 0
+        winner = None
+        delay = self._delay()
+        with self._lock:
+            self.stats["requests"] += 1
+
+        def launch():
+            index = len(started)
+            started.append(time.time())
+
+            def run():
+                try:
+                    chunks = iter(start(self.engines[index]))
+                except Exception as e:
+                    results.put((index, "error", e))
+                    return
+                if not hasattr(chunks, "close"):
+                    chunks = (chunk for chunk in chunks)
+                self._run(chunks, index, results, cancelled[index])
+
+            # Racers run under the caller's context so its deadlines still apply
+            self._executor.submit(contextvars.copy_context().run, run)
+
+        launch()
+        try:
+            while True:
+                timeout = None
+                if winner is None and len(started) < len(self.engines):
+                    timeout = max(0.0, started[-1] + delay - time.time())
+                try:
+                    index, kind, value = results.get(timeout=timeout)
+                except queue.Empty:
+                    logger.info(
+                        "Hedging request to %s after %.2fs",
+                        self.engines[len(started)].provider,
+                        delay,
+                    )
+                    launch()
+                    continue
+                if winner is not None and index != winner:
+                    continue
+                if kind == "error":
+                    if winner is not None:
+                        raise value
+                    with self._lock:
+                        self.stats["errors"] += 1
+                    failed += 1
+                    logger.warning(
+                        "Hedged backend %s failed: %s",
+                        self.engines[index].provider,
+                        value,
+                    )
+                    if failed < len(started):
+                        continue
+                    if len(started) < len(self.engines):
+                        launch()
+                        continue
+                    raise value
+                if winner is None:
+                    winner = index
+                    for i in range(len(started)):
+                        if i != winner:
+                            cancelled[i].set()
+                    self._won(index, time.time() - started[index], len(started) > 1)
+                if kind == "done":
+                    # Usage is only final once the winning stream is exhausted
+                    self.last_usage = self.engines[index].last_usage
+                    return
+                yield value
+        finally:
+            for event in cancelled:
+                event.set()
+
+    @with_retries
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return "".join(
+            self.generate_stream(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+        )
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return self._race(
+            lambda engine: engine.generate_stream(
+                convert_messages(messages, engine.message_format),
                 temperature=temperature,
+                max_new_tokens=max_new_tokens,
                 **kwargs,
             )
-            .choices[0]
-            .message.content
         )
+
+    @with_retries
+    def generate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        # Thinking responses are not streamed, a losing call finishes and is discarded
+        return "".join(
+            self._race(
+                lambda engine: [
+                    engine.generate_with_thinking(
+                        convert_messages(messages, engine.message_format),
+                        temperature=temperature,
+                        max_new_tokens=max_new_tokens,
+                        **kwargs,
+                    )
+                ]
+            )
+        )
+
+    async def _arace(self, start):
+        """Await whichever engine answers first and cancel the other tasks"""
+        tasks = {}
+        started = []
+        delay = self._delay()
+        error = None
+        with self._lock:
+            self.stats["requests"] += 1
+
+        def launch():
+            index = len(started)
+            started.append(time.time())
+            tasks[asyncio.ensure_future(start(self.engines[index]))] = index
+
+        launch()
+        try:
+            while tasks:
+                timeout = None
+                if len(started) < len(self.engines):
+                    timeout = max(0.0, started[-1] + delay - time.time())
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    launch()
+                    continue
+                for task in done:
+                    index = tasks.pop(task)
+                    if task.exception() is None:
+                        self._won(index, time.time() - started[index], len(started) > 1)
+                        return task.result()
+                    error = task.exception()
+                    with self._lock:
+                        self.stats["errors"] += 1
+                    logger.warning(
+                        "Hedged backend %s failed: %s",
+                        self.engines[index].provider,
+                        error,
+                    )
+                if not tasks and len(started) < len(self.engines):
+                    launch()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @with_retries
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return await self._arace(
+            lambda engine: engine.agenerate(
+                convert_messages(messages, engine.message_format),
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+        )
+
+    @with_retries
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        return await self._arace(
+            lambda engine: engine.agenerate_with_thinking(
+                convert_messages(messages, engine.message_format),
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+        )
+
+
+class LMMEngineBalanced(_CompositeEngine):
+    """Spreads requests over several engines by weight, latency and error rate.
+
+    Each engine in engines is an engine_params dict (with an optional "weight") or an
+    LMMEngine. A backend is picked at random with probability proportional to its
+    weight divided by its smoothed latency and scaled down by its smoothed error rate.
+    Consecutive failures open the backend's circuit breaker, which takes it out of
+    rotation until a trial call succeeds. A failed call is retried on another backend.
+    Messages are built in message_format and converted for each backend.
+    """
+
+    provider = "balanced"
+
+    def __init__(
+        self,
+        engines=None,
+        message_format="openai",
+        failure_threshold=3,
+        cooldown=30.0,
+        smoothing=0.2,
+        **kwargs,
+    ):
+        assert engines, "engines must list at least one backend"
+        self.engines = []
+        self.weights = []
+        for engine in engines:
+            if not isinstance(engine, LMMEngine):
+                engine = dict(engine)
+                self.weights.append(float(engine.pop("weight", 1.0)))
+            else:
+                self.weights.append(1.0)
+            self.engines.append(self._backend(engine))
+        self.message_format = message_format
+        self.model = getattr(self.engines[0], "model", None)
+        self.temperature = None
+        self.smoothing = smoothing
+        self.breakers = [
+            CircuitBreaker(failure_threshold=failure_threshold, cooldown=cooldown)
+            for _ in self.engines
+        ]
+        # Smoothed latency (None until the first success) and error rate per backend
+        self.latency = [None] * len(self.engines)
+        self.error_rate = [0.0] * len(self.engines)
+        self.calls = [0] * len(self.engines)
+        self.errors = [0] * len(self.engines)
+        self._lock = threading.Lock()
+
+    def _score(self, index):
+        with self._lock:
+            known = [latency for latency in self.latency if latency is not None]
+            # Untried backends are assumed to be as fast as the average one
+            latency = self.latency[index] or (sum(known) / len(known) if known else 1.0)
+            error_rate = self.error_rate[index]
+        return self.weights[index] / max(latency, 0.05) * max(1.0 - error_rate, 0.05)
+
+    def _pick(self, tried, method):
+        candidates = [
+            i
+            for i, engine in enumerate(self.engines)
+            if i not in tried
+            and self.breakers[i].available()
+            and hasattr(engine, method)
+        ]
+        while candidates:
+            index = random.choices(
+                candidates, weights=[self._score(i) for i in candidates]
+            )[0]
+            if self.breakers[index].allow():
+                return index
+            candidates.remove(index)
+        return None
+
+    def _observe(self, index, latency=None, error=None):
+        alpha = self.smoothing
+        with self._lock:
+            self.calls[index] += 1
+            self.error_rate[index] = (1 - alpha) * self.error_rate[index] + alpha * (
+                error is not None
+            )
+            if error is None:
+                previous = self.latency[index]
+                self.latency[index] = (
+                    latency
+                    if previous is None
+                    else (1 - alpha) * previous + alpha * latency
+                )
+            else:
+                self.errors[index] += 1
+        if error is None:
+            self.breakers[index].record_success()
+            self.last_usage = self.engines[index].last_usage
+            self.model = getattr(self.engines[index], "model", None)
+        else:
+            self.breakers[index].record_failure()
+            logger.warning(
+                "Balanced backend %s failed (%s): %s",
+                self.engines[index].provider,
+                self.breakers[index].state,
+                error,
+            )
+
+    def _attempts(self, method):
+        """Yield backend indices to try in order, until one of them succeeds"""
+        tried = set()
+        while True:
+            index = self._pick(tried, method)
+            if index is None:
+                return
+            tried.add(index)
+            yield index
+
+    def _call(self, method, messages, **kwargs):
+        error = None
+        for index in self._attempts(method):
+            engine = self.engines[index]
+            started = time.time()
+            try:
+                response = getattr(engine, method)(
+                    convert_messages(messages, engine.message_format), **kwargs
+                )
+            except Exception as e:
+                self._observe(index, error=e)
+                error = e
+                continue
+            self._observe(index, latency=time.time() - started)
+            return response
+        raise error or RuntimeError("No backend available: all circuits are open")
+
+    async def _acall(self, method, messages, **kwargs):
+        error = None
+        for index in self._attempts(method):
+            engine = self.engines[index]
+            started = time.time()
+            try:
+                response = await getattr(engine, method)(
+                    convert_messages(messages, engine.message_format), **kwargs
+                )
+            except Exception as e:
+                self._observe(index, error=e)
+                error = e
+                continue
+            self._observe(index, latency=time.time() - started)
+            return response
+        raise error or RuntimeError("No backend available: all circuits are open")
+
+    @with_retries
+    def generate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return self._call(
+            "generate",
+            messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+
+    @with_retries
+    def generate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        return self._call(
+            "generate_with_thinking",
+            messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+
+    @with_retries
+    async def agenerate(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        return await self._acall(
+            "agenerate",
+            messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+
+    @with_retries
+    async def agenerate_with_thinking(
+        self, messages, temperature=0.0, max_new_tokens=None, **kwargs
+    ):
+        return await self._acall(
+            "agenerate_with_thinking",
+            messages,
+            temperature=temperature,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+
+    def generate_stream(self, messages, temperature=0.0, max_new_tokens=None, **kwargs):
+        error = None
+        for index in self._attempts("generate_stream"):
+            engine = self.engines[index]
+            started = time.time()
+            received = False
+            try:
+                chunks = engine.generate_stream(
+                    convert_messages(messages, engine.message_format),
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                )
+                try:
+                    for chunk in chunks:
+                        received = True
+                        yield chunk
+                finally:
+                    chunks.close()
+            except GeneratorExit:
+                # Closed by the caller (early stop), the backend itself was healthy
+                self._observe(index, latency=time.time() - started)
+                raise
+            except Exception as e:
+                self._observe(index, error=e)
+                # Chunks already yielded cannot be taken back, only fail over before them
+                if received:
+                    raise
+                error = e
+                continue
+            self._observe(index, latency=time.time() - started)
+            return
+        raise error or RuntimeError("No backend available: all circuits are open")
+
+    def balancer_stats(self):
+        """Calls, errors, smoothed latency, breaker state and current share per backend"""
+        scores = [self._score(i) for i in range(len(self.engines))]
+        live = [
+            score if self.breakers[i].state != "open" else 0.0
+            for i, score in enumerate(scores)
+        ]
+        total = sum(live) or 1.0
+        with self._lock:
+            return {
+                f"{i}:{engine.provider}/{getattr(engine, 'model', None)}": {
+                    "weight": self.weights[i],
+                    "calls": self.calls[i],
+                    "errors": self.errors[i],
+                    "latency": self.latency[i],
+                    "error_rate": self.error_rate[i],
+                    "state": self.breakers[i].state,
+                    "share": live[i] / total,
+                }
+                for i, engine in enumerate(self.engines)
+            }
+
+
+# engine_type -> (engine class or "module:Class" path, provider SDK to import when built)
+ENGINE_REGISTRY = {
+    "openai": (LMMEngineOpenAI, "openai"),
+    "anthropic": (LMMEngineAnthropic, "anthropic"),
+    "azure": (LMMEngineAzureOpenAI, "openai"),
+    "vllm": (LMMEnginevLLM, "openai"),
+    "huggingface": (LMMEngineHuggingFace, "openai"),
+    "gemini": (LMMEngineGemini, "openai"),
+    "open_router": (LMMEngineOpenRouter, "openai"),
+    "parasail": (LMMEngineParasail, "openai"),
+    "replay": (LMMEngineReplay, None),
+    "hedged": (LMMEngineHedged, None),
+    "balanced": (LMMEngineBalanced, None),
+}
+
+
+def register_engine(engine_type, engine_cls, sdk=None):
+    """Make an engine buildable by engine_type; engine_cls may be a lazy "module:Class" path"""
+    ENGINE_REGISTRY[engine_type] = (engine_cls, sdk)
+
+
+def create_engine(engine_params):
+    """Build the engine named by engine_params["engine_type"], importing only its own SDK"""
+    engine_type = engine_params.get("engine_type")
+    if engine_type not in ENGINE_REGISTRY:
+        raise ValueError("engine_type is not supported")
+    engine_cls, sdk = ENGINE_REGISTRY[engine_type]
+    if isinstance(engine_cls, str):
+        module_name, _, cls_name = engine_cls.partition(":")
+        engine_cls = _sdk(module_name, cls_name)
+    if sdk is not None:
+        importlib.import_module(sdk)
+    engine = engine_cls(**engine_params)
+    retry_policy = engine_params.get("retry_policy")
+    if retry_policy is not None:
+        engine.retry_policy = (
+            retry_policy
+            if isinstance(retry_policy, RetryPolicy)
+            else RetryPolicy(**retry_policy)
+        )
+    # Log every request and response for offline replay
+    if engine_params.get("record_to"):
+        engine = LMMEngineRecorder(engine, engine_params["record_to"])
+    return engine
+
+
+def _warm_up(engine_params):
+    try:
+        create_engine(engine_params).warm_up()
+    except Exception as e:
+        logger.debug("Warm-up of %s failed: %s", engine_params.get("engine_type"), e)
+
+
+def warm_up_engines(engine_params_list, wait=False):
+    """Open pooled connections for the given engine_params on background threads.
+
+    Engines built later with the same settings reuse these connections, so the first
+    step does not pay for the TLS handshakes. Returns the threads (joined if wait).
+    """
+    threads = []
+    for engine_params in engine_params_list:
+        thread = threading.Thread(
+            target=_warm_up,
+            args=({**engine_params, "record_to": None},),
+            name="warm-up",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    if wait:
+        for thread in threads:
+            thread.join()
+    return threads
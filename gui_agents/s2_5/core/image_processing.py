@@ -0,0 +1,136 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Largest image each provider looks at without downscaling it server-side:
+# (max long side, max short side, max pixels). Uploading more only costs bytes.
+PROVIDER_PRESETS = {
+    # High detail: fit in 2048x2048, then the short side is scaled to 768
+    "openai": (2048, 768, None),
+    "azure": (2048, 768, None),
+    "open_router": (2048, 768, None),
+    # Long edge above 1568px (or about 1.15 megapixels) is downscaled
+    "anthropic": (1568, None, 1_150_000),
+    "gemini": (3072, None, None),
+}
+
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# Processed images shared by every preprocessor, keyed on input digest and settings
+_PROCESSED = OrderedDict()
+_PROCESSED_LOCK = threading.Lock()
+
+
+class ImagePreprocessor:
+    """Resizes and transcodes screenshots before they are attached to a message.
+
+    Images are scaled down (never up) to the provider's vision preset, or to fit in
+    target_size (the grounding model's coordinate space), and re-encoded as png, jpeg
+    or webp.
+    The OpenAI detail level can be chosen per agent role. Results are cached by the
+    content of the input, so agents sharing a screenshot process it once.
+    """
+
+    def __init__(
+        self,
+        provider: Optional[str] = None,
+        target_size: Optional[Tuple[int, int]] = None,
+        image_format: str = "png",
+        quality: int = 85,
+        detail="high",
+        max_entries: int = 16,
+    ):
+        if image_format not in MEDIA_TYPES:
+            raise ValueError(f"image_format must be one of {sorted(MEDIA_TYPES)}")
+        self.provider = provider
+        self.target_size = (
+            (int(target_size[0]), int(target_size[1])) if target_size else None
+        )
+        self.image_format = image_format
+        self.quality = quality
+        # One detail level for every role, or a {role: detail} mapping
+        self.detail = detail
+        self.max_entries = max_entries
+        self.stats = {"images": 0, "input_bytes": 0, "output_bytes": 0}
+        self._settings = (provider, self.target_size, image_format, quality)
+
+    @classmethod
+    def from_params(cls, engine_params: Dict, provider: Optional[str], role=None):
+        """Build the preprocessor described by engine_params["image_preprocessing"].
+
+        The setting may be True (provider preset, png) or a dict of constructor
+        arguments. Grounding agents resize to grounding_width x grounding_height.
+        """
+        settings = engine_params.get("image_preprocessing")
+        if not settings:
+            return None
+        settings = dict(settings) if isinstance(settings, dict) else {}
+        if role == "grounding" and engine_params.get("grounding_width"):
+            settings.setdefault(
+                "target_size",
+                (engine_params["grounding_width"], engine_params["grounding_height"]),
+            )
+        settings.setdefault("provider", provider)
+        return cls(**settings)
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.image_format]
+
+    def detail_for(self, role: Optional[str], default: str = "high") -> str:
+        if isinstance(self.detail, dict):
+            return self.detail.get(role, default)
+        return self.detail or default
+
+    def output_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Size an image of width x height is uploaded at"""
+        scale = 1.0
+        if self.target_size:
+            scale = min(
+                scale, self.target_size[0] / width, self.target_size[1] / height
+            )
+            return max(1, round(width * scale)), max(1, round(height * scale))
+        max_long, max_short, max_pixels = PROVIDER_PRESETS.get(
+            self.provider, (None, None, None)
+        )
+        if max_long:
+            scale = min(scale, max_long / max(width, height))
+        if max_short:
+            scale = min(scale, max_short / min(width, height))
+        if max_pixels:
+            scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def process(self, data: bytes) -> bytes:
+        """Resized and re-encoded image bytes, in self.media_type"""
+        key = (hashlib.blake2b(data, digest_size=16).digest(), self._settings)
+        with _PROCESSED_LOCK:
+            if key in _PROCESSED:
+                _PROCESSED.move_to_end(key)
+                return _PROCESSED[key]
+
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        size = self.output_size(*image.size)
+        if size == image.size and image.format.lower() == self.image_format:
+            processed = data
+        else:
+            if size != image.size:
+                image = image.resize(size, Image.LANCZOS)
+            if self.image_format == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.image_format.upper(), quality=self.quality)
+            processed = buffer.getvalue()
+
+        self.stats["images"] += 1
+        self.stats["input_bytes"] += len(data)
+        self.stats["output_bytes"] += len(processed)
+        with _PROCESSED_LOCK:
+            _PROCESSED[key] = processed
+            while len(_PROCESSED) > self.max_entries:
+                _PROCESSED.popitem(last=False)
+        return processed
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ImageRef:
+    """Lightweight handle on an image held by an ImageStore.
+
+    Message dicts keep these in place of base64 payloads, the provider payload is built
+    by resolving them when a request is sent. The store keeps an image while at least
+    one handle on it is alive.
+    """
+
+    __slots__ = ("store", "key", "prefix", "__weakref__")
+
+    def __init__(self, store: "ImageStore", key: str, prefix: str = ""):
+        self.store = store
+        self.key = key
+        # Prepended to the base64 payload, e.g. "data:image/png;base64,"
+        self.prefix = prefix
+        store._acquire(key)
+        weakref.finalize(self, store._release, key)
+
+    def data(self) -> bytes:
+        return self.store.get(self.key)
+
+    def fingerprint(self) -> str:
+        """Stable identity of the resolved payload, for request hashing"""
+        return f"{self.key}:{self.prefix}"
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"ImageRef({self.key!r}, prefix={self.prefix!r})"
+
+
+class ImageStore:
+    """Content-addressed store of the images referenced by agent messages.
+
+    Identical images are stored once, however many agents and messages refer to them,
+    and are dropped as soon as the last ImageRef on them is garbage collected. Once the
+    resident images exceed max_memory_bytes the least recently used ones are spilled
+    to spill_dir (a temporary directory, removed with the store, when not given) and
+    read back from disk on use.
+    """
+
+    def __init__(
+        self, max_memory_bytes: int = 64 * 1024 * 1024, spill_dir: Optional[str] = None
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+        self.memory_bytes = 0
+        self.stats = {"puts": 0, "deduplicated": 0, "spills": 0, "disk_reads": 0}
+        self._resident = OrderedDict()  # key -> bytes, least recently used first
+        self._spilled: Dict[str, str] = {}  # key -> file path
+        self._refcounts: Dict[str, int] = {}
+        self._recent = []  # (bytes object, key) of the latest puts
+        self._lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _key(self, data: bytes) -> str:
+        with self._lock:
+            for obj, key in self._recent:
+                if obj is data:
+                    return key
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        with self._lock:
+            self._recent = [(data, key)] + self._recent[:3]
+        return key
+
+    def put(self, data: bytes, prefix: str = "") -> ImageRef:
+        """Store data (if not already present) and return a new handle on it"""
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        key = self._key(data)
+        with self._lock:
+            self.stats["puts"] += 1
+            if key in self._resident or key in self._spilled:
+                self.stats["deduplicated"] += 1
+            else:
+                self._resident[key] = data
+                self.memory_bytes += len(data)
+            # Taking the handle before spilling keeps the new image from being dropped
+            ref = ImageRef(self, key, prefix)
+            self._spill()
+        return ref
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            data = self._resident.get(key)
+            if data is not None:
+                self._resident.move_to_end(key)
+                return data
+            path = self._spilled.get(key)
+            if path is None:
+                raise KeyError(f"Image {key} is no longer referenced")
+            self.stats["disk_reads"] += 1
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _spill(self):
+        if self.memory_bytes <= self.max_memory_bytes or len(self._resident) <= 1:
+            return
+        if not self.spill_dir:
+            self.spill_dir = tempfile.mkdtemp(prefix="gui_agents_images_")
+            weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+        while self.memory_bytes > self.max_memory_bytes and len(self._resident) > 1:
+            key, data = self._resident.popitem(last=False)
+            path = os.path.join(self.spill_dir, f"{key}.img")
+            with open(path, "wb") as f:
+                f.write(data)
+            self._spilled[key] = path
+            self.memory_bytes -= len(data)
+            self.stats["spills"] += 1
+
+    def _acquire(self, key: str):
+        with self._lock:
+            self._refcounts[key] = self._refcounts.get(key, 0) + 1
+
+    def _release(self, key: str):
+        with self._lock:
+            count = self._refcounts.get(key, 0) - 1
+            if count > 0:
+                self._refcounts[key] = count
+                return
+            self._refcounts.pop(key, None)
+            self._recent = [(obj, k) for obj, k in self._recent if k != key]
+            data = self._resident.pop(key, None)
+            if data is not None:
+                self.memory_bytes -= len(data)
+            path = self._spilled.pop(key, None)
+        if path is not None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._resident) + len(self._spilled)
+
+    def summary(self) -> Dict:
+        """Image counts, resident bytes and dedup/spill counters"""
+        with self._lock:
+            return {
+                "images": len(self._resident) + len(self._spilled),
+                "resident": len(self._resident),
+                "spilled": len(self._spilled),
+                "memory_bytes": self.memory_bytes,
+                **self.stats,
+            }
+
+
+_IMAGE_STORES: Dict[Optional[str], ImageStore] = {}
+_IMAGE_STORES_LOCK = threading.Lock()
+
+
+def get_image_store(spill_dir: Optional[str] = None, **kwargs) -> ImageStore:
+    """Return the ImageStore shared by every agent using the same spill directory"""
+    with _IMAGE_STORES_LOCK:
+        if spill_dir not in _IMAGE_STORES:
+            _IMAGE_STORES[spill_dir] = ImageStore(spill_dir=spill_dir, **kwargs)
+        return _IMAGE_STORES[spill_dir]
+
+
+def resolve_messages(messages, encode):
+    """Copy of messages with every ImageRef replaced by its encode(data, prefix, key).
+
+    data is passed as the ref's data method, so encode only reads the image (from disk,
+    if it was spilled) when it has no encoding for key yet. Messages without image
+    handles are passed through as they are, the stored messages themselves are never
+    modified.
+    """
+    resolved = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str) or not any(
+            isinstance(_payload(part), ImageRef) for part in content
+        ):
+            resolved.append(message)
+            continue
+        parts = []
+        for part in content:
+            ref = _payload(part)
+            if not isinstance(ref, ImageRef):
+                parts.append(part)
+            elif part.get("type") == "image":
+                data = encode(ref.data, ref.prefix, ref.key)
+                parts.append({**part, "source": {**part["source"], "data": data}})
+            else:
+                url = encode(ref.data, ref.prefix, ref.key)
+                parts.append({**part, "image_url": {**part["image_url"], "url": url}})
+        resolved.append({**message, "content": parts})
+    return resolved
+
+
+def _payload(part):
+    if part.get("type") == "image_url":
+        return part["image_url"]["url"]
+    if part.get("type") == "image":
+        return part.get("source", {}).get("data")
+    return None
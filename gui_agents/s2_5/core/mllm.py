@@ -1,61 +1,263 @@
 import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
 
-import numpy as np
+from gui_agents.s2_5.core.engine import create_engine
+from gui_agents.s2_5.core.image_processing import ImagePreprocessor
+from gui_agents.s2_5.core.image_store import get_image_store, resolve_messages
+from gui_agents.s2_5.utils.common_utils import fingerprint_request
 
-from gui_agents.s2_5.core.engine import (
-    LMMEngineAnthropic,
-    LMMEngineAzureOpenAI,
-    LMMEngineHuggingFace,
-    LMMEngineOpenAI,
-    LMMEngineOpenRouter,
-    LMMEngineParasail,
-    LMMEnginevLLM,
-    LMMEngineGemini,
-)
+
+def _is_ndarray(value):
+    # Avoids importing numpy just for an isinstance check
+    return type(value).__name__ == "ndarray" and type(value).__module__ == "numpy"
+
+
+class EncodedImageCache:
+    """Base64 encodings of recent images, keyed on a blake2b hash of their bytes.
+
+    Every agent of a step receives the same screenshot, with this cache it is encoded
+    once per layout (bare base64 or a data URL) and all message dicts share the one
+    string. Callers that already know the digest (e.g. an ImageRef key) skip the
+    hashing. Only digests and encodings are kept, never the raw image bytes.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def encode(self, data, prefix="", digest=None):
+        """prefix + base64(data), computed at most once for the same bytes and prefix.
+
+        digest, when given, must be the blake2b-16 hex digest of data. data may then
+        be a function returning the bytes, called only on a cache miss (e.g. to avoid
+        reading a spilled image back from disk).
+        """
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        key = (digest, prefix)
+        with self._lock:
+            encoded = self.entries.get(key)
+            if encoded is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        if callable(data):
+            data = data()
+        encoded = prefix + base64.b64encode(data).decode("utf-8")
+        with self._lock:
+            self.entries[key] = encoded
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return encoded
+
+
+ENCODED_IMAGES = EncodedImageCache()
+
+
+class ResponseCache:
+    """Content-addressed cache of model responses.
+
+    Responses are kept in an in-memory LRU and, when cache_dir is given, in one JSON
+    file per key on disk so they survive across runs. Entries older than ttl seconds
+    are ignored, and the disk layer is trimmed oldest-first to max_disk_bytes.
+    By default only deterministic (temperature 0) requests are cached.
+    """
+
+    def __init__(
+        self,
+        cache_dir=None,
+        max_entries=512,
+        max_disk_bytes=256 * 1024 * 1024,
+        ttl=None,
+        deterministic_only=True,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.deterministic_only = deterministic_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._disk_index = OrderedDict()  # key -> file size, oldest access first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = []
+            for entry in os.scandir(cache_dir):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk_index[key] = size
+                self._disk_bytes += size
+
+    def accepts(self, temperature):
+        return not self.deterministic_only or not temperature
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if self.cache_dir and key in self._disk_index:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        record = json.load(f)
+                except (OSError, ValueError):
+                    record = None
+                if record is not None and not self._expired(record["created"]):
+                    os.utime(self._path(key))
+                    self._disk_index.move_to_end(key)
+                    self._remember(key, record["created"], record["response"])
+                    self.hits += 1
+                    return record["response"]
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, response)
+            if self.cache_dir:
+                data = json.dumps({"created": created, "response": response})
+                with open(self._path(key), "w", encoding="utf-8") as f:
+                    f.write(data)
+                self._disk_bytes += len(data) - self._disk_index.pop(key, 0)
+                self._disk_index[key] = len(data)
+                while (
+                    self._disk_bytes > self.max_disk_bytes and len(self._disk_index) > 1
+                ):
+                    old_key, size = self._disk_index.popitem(last=False)
+                    self._disk_bytes -= size
+                    self.evictions += 1
+                    try:
+                        os.remove(self._path(old_key))
+                    except OSError:
+                        pass
+
+    def _remember(self, key, created, response):
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            if not self.cache_dir:
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._disk_index) if self.cache_dir else len(self._memory),
+        }
+
+
+_RESPONSE_CACHES = {}
+
+
+def get_response_cache(cache_dir=None, **kwargs):
+    """Return the ResponseCache shared by every agent using the same cache directory"""
+    if cache_dir not in _RESPONSE_CACHES:
+        _RESPONSE_CACHES[cache_dir] = ResponseCache(cache_dir, **kwargs)
+    return _RESPONSE_CACHES[cache_dir]
 
 
 class LMMAgent:
-    def __init__(self, engine_params=None, system_prompt=None, engine=None):
+    def __init__(
+        self,
+        engine_params=None,
+        system_prompt=None,
+        engine=None,
+        cache=None,
+        role=None,
+    ):
         if engine is None:
             if engine_params is not None:
-                engine_type = engine_params.get("engine_type")
-                if engine_type == "openai":
-                    self.engine = LMMEngineOpenAI(**engine_params)
-                elif engine_type == "anthropic":
-                    self.engine = LMMEngineAnthropic(**engine_params)
-                elif engine_type == "azure":
-                    self.engine = LMMEngineAzureOpenAI(**engine_params)
-                elif engine_type == "vllm":
-                    self.engine = LMMEnginevLLM(**engine_params)
-                elif engine_type == "huggingface":
-                    self.engine = LMMEngineHuggingFace(**engine_params)
-                elif engine_type == "gemini":
-                    self.engine = LMMEngineGemini(**engine_params)
-                elif engine_type == "open_router":
-                    self.engine = LMMEngineOpenRouter(**engine_params)
-                elif engine_type == "parasail":
-                    self.engine = LMMEngineParasail(**engine_params)
-                else:
-                    raise ValueError("engine_type is not supported")
+                self.engine = create_engine(engine_params)
             else:
                 raise ValueError("engine_params must be provided")
         else:
             self.engine = engine
 
+        # Optional response cache, either passed in or named by engine_params["response_cache"]
+        if cache is None and engine_params is not None:
+            cache = engine_params.get("response_cache")
+        if cache is True or isinstance(cache, str):
+            cache = get_response_cache(cache if isinstance(cache, str) else None)
+        self.cache = cache or None
+
+        # Telemetry: calls are recorded into usage_tracker (when set) tagged with this role
+        self.role = role
+        self.usage_tracker = None
+
+        # Optional resize/transcode of images before upload, see ImagePreprocessor
+        self.image_preprocessor = (
+            ImagePreprocessor.from_params(
+                engine_params, getattr(self.engine, "provider", None), role
+            )
+            if engine_params is not None
+            else None
+        )
+
+        # Messages hold ImageRef handles into this store instead of base64 payloads,
+        # configured by engine_params["image_store"] (max_memory_bytes, spill_dir)
+        store_params = (engine_params or {}).get("image_store") or {}
+        self.image_store = get_image_store(**store_params)
+
         self.messages = []  # Empty messages
+        # (message, part) of every image in self.messages, oldest first
+        self.image_parts = deque()
 
         if system_prompt:
             self.add_system_prompt(system_prompt)
         else:
             self.add_system_prompt("You are a helpful assistant.")
 
-    def encode_image(self, image_content):
-        # if image_content is a path to an image file, check type of the image_content to verify
+    @property
+    def image_media_type(self):
+        if self.image_preprocessor is None:
+            return "image/png"
+        return self.image_preprocessor.media_type
+
+    def store_image(self, image_content, prefix=""):
+        """Put image bytes (or an image file path) in the image store, preprocessed.
+
+        Returns an ImageRef, which is base64-encoded only when a request is sent.
+        """
         if isinstance(image_content, str):
             with open(image_content, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode("utf-8")
-        else:
-            return base64.b64encode(image_content).decode("utf-8")
+                image_content = image_file.read()
+        if self.image_preprocessor is not None:
+            image_content = self.image_preprocessor.process(image_content)
+        return self.image_store.put(image_content, prefix)
+
+    def _image_detail(self, image_detail):
+        if self.image_preprocessor is None:
+            return image_detail
+        return self.image_preprocessor.detail_for(self.role, image_detail)
 
     def reset(
         self,
@@ -67,6 +269,46 @@ class LMMAgent:
                 "content": [{"type": "text", "text": self.system_prompt}],
             }
         ]
+        self.image_parts.clear()
+
+    def _track_images(self, message):
+        for part in message["content"]:
+            if "image" in part.get("type", ""):
+                self.image_parts.append((message, part))
+
+    def _forget_images(self, message):
+        """Stop tracking the images of a message that is being removed"""
+        count = sum("image" in part.get("type", "") for part in message["content"])
+        # Turns are dropped from the front and rolled back from the back, O(1) each
+        while count and self.image_parts and self.image_parts[0][0] is message:
+            self.image_parts.popleft()
+            count -= 1
+        while count and self.image_parts and self.image_parts[-1][0] is message:
+            self.image_parts.pop()
+            count -= 1
+        if count:
+            self.image_parts = deque(
+                entry for entry in self.image_parts if entry[0] is not message
+            )
+
+    @property
+    def image_count(self):
+        return len(self.image_parts)
+
+    def evict_oldest_image(self):
+        """Remove the oldest image still in the messages, keeping its message's text"""
+        message, part = self.image_parts.popleft()
+        content = message["content"]
+        for j, candidate in enumerate(content):
+            if candidate is part:
+                del content[j]
+                break
+
+    def truncate_messages(self, length):
+        """Drop every message after the first length ones"""
+        for message in reversed(self.messages[length:]):
+            self._forget_images(message)
+        del self.messages[length:]
 
     def add_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -86,28 +328,33 @@ class LMMAgent:
     def remove_message_at(self, index):
         """Remove a message at a given index"""
         if index < len(self.messages):
-            self.messages.pop(index)
+            self._forget_images(self.messages.pop(index))
 
     def replace_message_at(
         self, index, text_content, image_content=None, image_detail="high"
     ):
         """Replace a message at a given index"""
+        image_detail = self._image_detail(image_detail)
         if index < len(self.messages):
+            self._forget_images(self.messages[index])
             self.messages[index] = {
                 "role": self.messages[index]["role"],
                 "content": [{"type": "text", "text": text_content}],
             }
             if image_content:
-                base64_image = self.encode_image(image_content)
+                image_ref = self.store_image(
+                    image_content, f"data:{self.image_media_type};base64,"
+                )
                 self.messages[index]["content"].append(
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}",
+                            "url": image_ref,
                             "detail": image_detail,
                         },
                     }
                 )
+            self._track_images(self.messages[index])
 
     def add_message(
         self,
@@ -119,18 +366,11 @@ class LMMAgent:
     ):
         """Add a new message to the list of messages"""
 
+        message_format = getattr(self.engine, "message_format", None)
+        image_detail = self._image_detail(image_detail)
+
         # API-style inference from OpenAI and AzureOpenAI
-        if isinstance(
-            self.engine,
-            (
-                LMMEngineOpenAI,
-                LMMEngineAzureOpenAI,
-                LMMEngineHuggingFace,
-                LMMEngineGemini,
-                LMMEngineOpenRouter,
-                LMMEngineParasail,
-            ),
-        ):
+        if message_format == "openai":
             # infer role from previous message
             if role != "user":
                 if self.messages[-1]["role"] == "system":
@@ -145,29 +385,33 @@ class LMMAgent:
                 "content": [{"type": "text", "text": text_content}],
             }
 
-            if isinstance(image_content, np.ndarray) or image_content:
+            if _is_ndarray(image_content) or image_content:
                 # Check if image_content is a list or a single image
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
+                        image_ref = self.store_image(
+                            image, f"data:{self.image_media_type};base64,"
+                        )
                         message["content"].append(
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}",
+                                    "url": image_ref,
                                     "detail": image_detail,
                                 },
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
+                    image_ref = self.store_image(
+                        image_content, f"data:{self.image_media_type};base64,"
+                    )
                     message["content"].append(
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}",
+                                "url": image_ref,
                                 "detail": image_detail,
                             },
                         }
@@ -181,7 +425,7 @@ class LMMAgent:
             self.messages.append(message)
 
         # For API-style inference from Anthropic
-        elif isinstance(self.engine, LMMEngineAnthropic):
+        elif message_format == "anthropic":
             # infer role from previous message
             if role != "user":
                 if self.messages[-1]["role"] == "system":
@@ -201,34 +445,34 @@ class LMMAgent:
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
+                        image_ref = self.store_image(image)
                         message["content"].append(
                             {
                                 "type": "image",
                                 "source": {
                                     "type": "base64",
-                                    "media_type": "image/png",
-                                    "data": base64_image,
+                                    "media_type": self.image_media_type,
+                                    "data": image_ref,
                                 },
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
+                    image_ref = self.store_image(image_content)
                     message["content"].append(
                         {
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image,
+                                "media_type": self.image_media_type,
+                                "data": image_ref,
                             },
                         }
                     )
             self.messages.append(message)
 
         # Locally hosted vLLM model inference
-        elif isinstance(self.engine, LMMEnginevLLM):
+        elif message_format == "vllm":
             # infer role from previous message
             if role != "user":
                 if self.messages[-1]["role"] == "system":
@@ -248,28 +492,54 @@ class LMMAgent:
                 if isinstance(image_content, list):
                     # If image_content is a list of images, loop through each image
                     for image in image_content:
-                        base64_image = self.encode_image(image)
+                        image_ref = self.store_image(image, "data:image;base64,")
                         message["content"].append(
                             {
                                 "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image;base64,{base64_image}"
-                                },
+                                "image_url": {"url": image_ref},
                             }
                         )
                 else:
                     # If image_content is a single image, handle it directly
-                    base64_image = self.encode_image(image_content)
+                    image_ref = self.store_image(image_content, "data:image;base64,")
                     message["content"].append(
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:image;base64,{base64_image}"},
+                            "image_url": {"url": image_ref},
                         }
                     )
 
             self.messages.append(message)
         else:
             raise ValueError("engine_type is not supported")
+        self._track_images(message)
+
+    def _prepare_messages(self, user_message=None, messages=None):
+        if messages is None:
+            messages = self.messages
+        if user_message:
+            messages.append(
+                {"role": "user", "content": [{"type": "text", "text": user_message}]}
+            )
+        return messages
+
+    def _cache_key(self, messages, temperature, **params):
+        if self.cache is None:
+            return None
+        # Engine-level temperature overrides the per-call one when it is set
+        engine_temperature = getattr(self.engine, "temperature", None)
+        if not self.cache.accepts(
+            temperature if engine_temperature is None else engine_temperature
+        ):
+            return None
+        return fingerprint_request(
+            messages,
+            engine=type(self.engine).__name__,
+            model=getattr(self.engine, "model", None),
+            temperature=temperature,
+            engine_temperature=engine_temperature,
+            **params,
+        )
 
     def get_response(
         self,
@@ -278,29 +548,153 @@ class LMMAgent:
         temperature=0.0,
         max_new_tokens=None,
         use_thinking=False,
+        stream=False,
+        stop_when=None,
+        cancel=None,
         **kwargs,
     ):
-        """Generate the next response based on previous messages"""
-        if messages is None:
-            messages = self.messages
-        if user_message:
-            messages.append(
-                {"role": "user", "content": [{"type": "text", "text": user_message}]}
-            )
+        """Generate the next response based on previous messages
+
+        With stream=True the response is consumed incrementally, and the request is
+        cancelled as soon as stop_when(response_so_far) returns True, or once the
+        threading.Event cancel is set (raising concurrent.futures.CancelledError).
+        """
+        messages = self._prepare_messages(user_message, messages)
 
+        cache_key = self._cache_key(
+            messages,
+            temperature,
+            max_new_tokens=max_new_tokens,
+            use_thinking=use_thinking,
+            stop_when=getattr(stop_when, "__name__", None) if stream else None,
+            **kwargs,
+        )
+        started = time.time()
+        retries_before = getattr(self.engine, "retry_count", 0)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self._record_call(started, retries_before, cache_hit=True)
+                return cached
+
+        ttft = None
+        # Build the provider payload from the stored image handles
+        messages = resolve_messages(messages, ENCODED_IMAGES.encode)
         # Thinking enabled for Claude Sonnet 3.7 and Gemini 2.5 Pro
         if use_thinking:
-            return self.engine.generate_with_thinking(
+            response = self.engine.generate_with_thinking(
                 messages,
                 temperature=temperature,
                 max_new_tokens=max_new_tokens,
                 **kwargs,
             )
-
+        elif stream:
+            response, ttft = self._consume_stream(
+                self.engine.generate_stream(
+                    messages,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    **kwargs,
+                ),
+                stop_when,
+                cancel,
+            )
+            if cancel is not None and cancel.is_set():
+                # The tokens streamed so far are still billed
+                self._record_call(started, retries_before, ttft=ttft)
+                raise concurrent.futures.CancelledError("Request cancelled")
         # Regular generation
-        return self.engine.generate(
+        else:
+            response = self.engine.generate(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+
+        self._record_call(started, retries_before, ttft=ttft)
+        if cache_key is not None and response:
+            self.cache.put(cache_key, response)
+        return response
+
+    @staticmethod
+    def _consume_stream(chunks, stop_when=None, cancel=None):
+        """Accumulate a response stream, returns the text and the time to its first chunk"""
+        response = ""
+        ttft = None
+        started = time.time()
+        try:
+            for chunk in chunks:
+                if ttft is None:
+                    ttft = time.time() - started
+                response += chunk
+                if stop_when is not None and stop_when(response):
+                    break
+                if cancel is not None and cancel.is_set():
+                    break
+        finally:
+            # Closing the generator closes the underlying HTTP stream
+            chunks.close()
+        return response, ttft
+
+    def _record_call(self, started, retries_before, ttft=None, cache_hit=False):
+        if self.usage_tracker is None:
+            return
+        self.usage_tracker.record(
+            role=self.role,
+            model=getattr(self.engine, "model", None),
+            usage=None if cache_hit else getattr(self.engine, "last_usage", None),
+            latency=time.time() - started,
+            ttft=ttft,
+            retries=getattr(self.engine, "retry_count", 0) - retries_before,
+            cache_hit=cache_hit,
+        )
+
+    async def aget_response(
+        self,
+        user_message=None,
+        messages=None,
+        temperature=0.0,
+        max_new_tokens=None,
+        use_thinking=False,
+        **kwargs,
+    ):
+        """Async counterpart of get_response, built on the engine's agenerate"""
+        messages = self._prepare_messages(user_message, messages)
+
+        cache_key = self._cache_key(
             messages,
-            temperature=temperature,
+            temperature,
             max_new_tokens=max_new_tokens,
+            use_thinking=use_thinking,
+            stop_when=None,
             **kwargs,
         )
+        started = time.time()
+        retries_before = getattr(self.engine, "retry_count", 0)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self._record_call(started, retries_before, cache_hit=True)
+                return cached
+
+        messages = resolve_messages(messages, ENCODED_IMAGES.encode)
+        if use_thinking:
+            response = await self.engine.agenerate_with_thinking(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+        else:
+            response = await self.engine.agenerate(
+                messages,
+                temperature=temperature,
+                max_new_tokens=max_new_tokens,
+                **kwargs,
+            )
+
+        self._record_call(started, retries_before)
+        if cache_key is not None and response:
+            self.cache.put(cache_key, response)
+        return response
@@ -8,10 +8,13 @@ class BaseModule:
         self.platform = platform
 
     def _create_agent(
-        self, system_prompt: str = None, engine_params: Optional[Dict] = None
+        self,
+        system_prompt: str = None,
+        engine_params: Optional[Dict] = None,
+        role: Optional[str] = None,
     ) -> LMMAgent:
         """Create a new LMMAgent instance"""
-        agent = LMMAgent(engine_params or self.engine_params)
+        agent = LMMAgent(engine_params or self.engine_params, role=role)
         if system_prompt:
             agent.add_system_prompt(system_prompt)
         return agent
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to per-process limiting
+    fcntl = None
+
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), "gui_agents_rate_limits")
+
+# Rough per-image cost used when estimating request size before it is sent
+IMAGE_TOKEN_ESTIMATE = 1000
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests and tokens per minute.
+
+    Each call reserves its cost up front and sleeps until the buckets would have
+    refilled, so concurrent callers are spaced out instead of bursting into 429s.
+    Bucket levels live in a small JSON file guarded by an exclusive file lock, which
+    lets threads and separate processes on the same host share one budget.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float = -1,
+        tokens_per_minute: float = -1,
+        burst_seconds: float = 6.0,
+        state_dir: Optional[str] = None,
+    ):
+        self.name = name
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.burst_seconds = burst_seconds
+        self._thread_lock = threading.Lock()
+        self._local_state: Dict = {}
+        self._state_path = None
+        if fcntl is not None:
+            state_dir = state_dir or DEFAULT_STATE_DIR
+            os.makedirs(state_dir, exist_ok=True)
+            self._state_path = os.path.join(state_dir, f"{name}.json")
+
+    def tighten(self, requests_per_minute: float = -1, tokens_per_minute: float = -1):
+        """Apply the stricter of the current and the given limits"""
+        for kind, limit in (
+            ("requests", requests_per_minute),
+            ("tokens", tokens_per_minute),
+        ):
+            if limit > 0 and (self.limits[kind] <= 0 or limit < self.limits[kind]):
+                self.limits[kind] = limit
+
+    def _capacity(self, kind: str) -> float:
+        per_minute = self.limits[kind]
+        capacity = per_minute * self.burst_seconds / 60.0
+        return max(capacity, 1.0) if kind == "requests" else capacity
+
+    @contextmanager
+    def _locked_state(self):
+        with self._thread_lock:
+            if self._state_path is None:
+                yield self._local_state
+                return
+            with open(self._state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self, requests: float = 1, tokens: float = 0) -> float:
+        """Take the given cost out of the buckets and return how long to wait before sending"""
+        wait = 0.0
+        with self._locked_state() as state:
+            now = time.time()
+            for kind, cost in (("requests", requests), ("tokens", tokens)):
+                limit = self.limits[kind]
+                if limit <= 0 or not cost:
+                    continue
+                rate = limit / 60.0
+                capacity = self._capacity(kind)
+                level, updated = state.get(kind, (capacity, now))
+                level = min(capacity, level + max(0.0, now - updated) * rate) - cost
+                level = min(capacity, level)
+                state[kind] = (level, now)
+                if level < 0:
+                    wait = max(wait, -level / rate)
+        return wait
+
+    def acquire(self, tokens: float = 0):
+        wait = self.reserve(requests=1, tokens=tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: float = 0):
+        wait = self.reserve(requests=1, tokens=tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: float, actual_tokens: Optional[float]):
+        """Correct the token bucket once the real usage of a request is known"""
+        if actual_tokens is None:
+            return
+        self.reserve(requests=0, tokens=actual_tokens - estimated_tokens)
+
+
+_RATE_LIMITERS: Dict[str, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(
+    provider: str,
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    requests_per_minute: float = -1,
+    tokens_per_minute: float = -1,
+) -> Optional[RateLimiter]:
+    """Return the limiter shared by every engine using the same provider, endpoint and key"""
+    if requests_per_minute <= 0 and tokens_per_minute <= 0:
+        return None
+    digest = hashlib.sha256(
+        f"{provider}|{base_url or ''}|{api_key or ''}".encode("utf-8")
+    ).hexdigest()[:16]
+    name = f"{provider}-{digest}"
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(name)
+        if limiter is None:
+            limiter = RateLimiter(name, requests_per_minute, tokens_per_minute)
+            _RATE_LIMITERS[name] = limiter
+        else:
+            limiter.tighten(requests_per_minute, tokens_per_minute)
+    return limiter
+
+
+def estimate_message_tokens(messages) -> int:
+    """Cheap pre-flight estimate of prompt tokens (about 4 characters per token)"""
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            elif "image" in part.get("type", ""):
+                images += 1
+    return chars // 4 + images * IMAGE_TOKEN_ESTIMATE
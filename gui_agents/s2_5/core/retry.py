@@ -0,0 +1,189 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+logger = logging.getLogger("desktopenv.agent")
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# Matched on the exception class name so no provider SDK has to be imported
+RETRYABLE_ERRORS = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "RateLimitError",
+    "InternalServerError",
+    "OverloadedError",
+    "ServiceUnavailableError",
+    "ConnectionError",
+    "ConnectionResetError",
+    "TimeoutError",
+    "ReadTimeout",
+    "ConnectTimeout",
+    "RemoteProtocolError",
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the time budget of a step or of the whole game has been spent"""
+
+    def __init__(self, scope: str, message: Optional[str] = None):
+        super().__init__(message or f"The {scope} time budget is exhausted")
+        self.scope = scope
+
+
+class RetriesExhausted(RuntimeError):
+    """Raised when a call still fails after the last attempt allowed by its policy"""
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and total time"""
+
+    max_attempts: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    max_time: float = 60.0
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        # Honour the provider's Retry-After when it asks for a longer pause
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+_deadlines = contextvars.ContextVar("llm_deadlines", default=())
+
+
+def _retry_after(error) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed model call may succeed if sent again"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+@contextmanager
+def deadline(seconds: Optional[float], scope: str):
+    """Bound every model call made inside the block (and its retries) to seconds.
+
+    Deadlines nest: a step budget inside a game budget ends at whichever comes first.
+    A falsy seconds leaves the block unbounded.
+    """
+    if not seconds or seconds <= 0:
+        yield
+        return
+    token = _deadlines.set(_deadlines.get() + ((time.monotonic() + seconds, scope),))
+    try:
+        yield
+    finally:
+        _deadlines.reset(token)
+
+
+def time_remaining() -> Tuple[Optional[float], Optional[str]]:
+    """Seconds left before the nearest active deadline and its scope, or (None, None)"""
+    active = _deadlines.get()
+    if not active:
+        return None, None
+    ends, scope = min(active)
+    return ends - time.monotonic(), scope
+
+
+def check_deadline():
+    remaining, scope = time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(scope)
+
+
+def _next_delay(policy, attempt, error, started):
+    """Seconds to wait before the next attempt, or raise if the call should give up"""
+    if not is_retryable(error):
+        raise error
+    if attempt + 1 >= policy.max_attempts:
+        raise RetriesExhausted(
+            f"Giving up after {attempt + 1} attempts: {error}"
+        ) from error
+    delay = policy.delay(attempt, error)
+    if time.monotonic() - started + delay > policy.max_time:
+        raise RetriesExhausted(
+            f"Giving up after {policy.max_time:.0f}s of retries: {error}"
+        ) from error
+    remaining, scope = time_remaining()
+    if remaining is not None and delay >= remaining:
+        raise DeadlineExceeded(scope) from error
+    return delay
+
+
+def with_retries(func):
+    """Retry an engine method under the engine's retry_policy and the active deadlines.
+
+    Only retryable errors are retried, the rest are raised straight away. Each retry
+    increments the engine's retry_count.
+    """
+
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            policy = getattr(self, "retry_policy", None) or DEFAULT_RETRY_POLICY
+            started = time.monotonic()
+            attempt = 0
+            while True:
+                check_deadline()
+                try:
+                    return await func(self, *args, **kwargs)
+                except Exception as e:
+                    delay = _next_delay(policy, attempt, e, started)
+                    logger.info(
+                        "Retrying %s in %.1fs after: %s", func.__qualname__, delay, e
+                    )
+                self.retry_count += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        policy = getattr(self, "retry_policy", None) or DEFAULT_RETRY_POLICY
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            check_deadline()
+            try:
+                return func(self, *args, **kwargs)
+            except Exception as e:
+                delay = _next_delay(policy, attempt, e, started)
+                logger.info(
+                    "Retrying %s in %.1fs after: %s", func.__qualname__, delay, e
+                )
+            self.retry_count += 1
+            attempt += 1
+            time.sleep(delay)
+
+    return wrapper
@@ -0,0 +1,50 @@
+import io
+
+# Screens are compared as grayscale thumbnails this many pixels wide
+SIGNATURE_WIDTH = 256
+# Thumbnail pixels whose brightness moved by more than this count as changed
+PIXEL_TOLERANCE = 0.1
+
+
+def screen_signature(image_bytes: bytes, width: int = SIGNATURE_WIDTH):
+    """Grayscale thumbnail of a screenshot as a float32 array in [0, 1]"""
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes)).convert("L")
+    height = max(1, round(image.height * width / image.width))
+    image = image.resize((width, height), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def screen_difference(previous, current) -> float:
+    """Fraction of thumbnail pixels that changed between two signatures (1.0 if resized)"""
+    import numpy as np
+
+    if previous is None or previous.shape != current.shape:
+        return 1.0
+    return float(np.mean(np.abs(current - previous) > PIXEL_TOLERANCE))
+
+
+class ScreenChangeDetector:
+    """Tells whether a screenshot differs meaningfully from the previous one.
+
+    A step that changed less than threshold of the screen (e.g. a wait while nothing
+    happened, or a click that missed) can skip its model calls.
+    """
+
+    def __init__(self, threshold: float = 0.0002):
+        self.threshold = threshold
+        self.last_signature = None
+        self.last_difference = None
+
+    def changed(self, image_bytes: bytes) -> bool:
+        """Compare with the previous screenshot and remember this one"""
+        signature = screen_signature(image_bytes)
+        self.last_difference = screen_difference(self.last_signature, signature)
+        self.last_signature = signature
+        return self.last_difference > self.threshold
+
+    def reset(self):
+        self.last_signature = None
+        self.last_difference = None
@@ -0,0 +1,127 @@
+import threading
+from typing import Dict, List, Optional
+
+# Estimated USD per million tokens: (input, cached input, output).
+# Matched on the longest model-name prefix, unknown models are reported without a cost.
+MODEL_PRICING = {
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4.1-mini": (0.4, 0.1, 1.6),
+    "gpt-4.1-nano": (0.1, 0.025, 0.4),
+    "gpt-4.1": (2.0, 0.5, 8.0),
+    "gpt-5-mini": (0.25, 0.025, 2.0),
+    "gpt-5-nano": (0.05, 0.005, 0.4),
+    "gpt-5": (1.25, 0.125, 10.0),
+    "o3": (2.0, 0.5, 8.0),
+    "o4-mini": (1.1, 0.275, 4.4),
+    "claude-3-5-haiku": (0.8, 0.08, 4.0),
+    "claude-3-7-sonnet": (3.0, 0.3, 15.0),
+    "claude-sonnet-4": (3.0, 0.3, 15.0),
+    "claude-opus-4": (15.0, 1.5, 75.0),
+    "gemini-2.5-pro": (1.25, 0.31, 10.0),
+    "gemini-2.5-flash": (0.3, 0.075, 2.5),
+}
+
+# Cache writes are billed at a premium on Anthropic
+CACHE_WRITE_MULTIPLIER = 1.25
+
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cached_tokens",
+    "cache_write_tokens",
+    "thinking_tokens",
+    "latency",
+    "retries",
+    "cost",
+    "skipped",
+)
+
+
+def estimate_cost(model: Optional[str], usage: Optional[Dict]) -> Optional[float]:
+    """Estimated USD cost of one call, or None when the model or its usage is unknown"""
+    if not model or not usage:
+        return None
+    name = model.split("/")[-1]
+    prefixes = [prefix for prefix in MODEL_PRICING if name.startswith(prefix)]
+    if not prefixes:
+        return None
+    input_price, cached_price, output_price = MODEL_PRICING[max(prefixes, key=len)]
+    cached = usage.get("cached_tokens", 0)
+    cache_write = usage.get("cache_write_tokens", 0)
+    uncached = usage.get("input_tokens", 0) - cached - cache_write
+    return (
+        uncached * input_price
+        + cached * cached_price
+        + cache_write * input_price * CACHE_WRITE_MULTIPLIER
+        + usage.get("output_tokens", 0) * output_price
+    ) / 1_000_000
+
+
+class UsageTracker:
+    """Collects one record per model call, tagged with the agent role and step number"""
+
+    def __init__(self):
+        self.records: List[Dict] = []
+        self.step = 0
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        role: Optional[str],
+        model: Optional[str],
+        usage: Optional[Dict],
+        latency: float,
+        ttft: Optional[float] = None,
+        retries: int = 0,
+        cache_hit: bool = False,
+    ):
+        usage = usage or {}
+        record = {
+            "role": role,
+            "step": self.step,
+            "model": model,
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cached_tokens": usage.get("cached_tokens", 0),
+            "cache_write_tokens": usage.get("cache_write_tokens", 0),
+            "thinking_tokens": usage.get("thinking_tokens", 0),
+            "estimated_tokens": usage.get("estimated", False),
+            "latency": latency,
+            "ttft": ttft,
+            "retries": retries,
+            "cache_hit": cache_hit,
+            "cost": 0.0 if cache_hit else estimate_cost(model, usage),
+            "skipped": False,
+        }
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def record_skip(self, role: Optional[str]):
+        """Count a model call that was not made because the screen had not changed"""
+        record = {field: 0 for field in USAGE_FIELDS}
+        record.update(role=role, step=self.step, model=None, skipped=True)
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def summary(self, step: Optional[int] = None) -> Dict:
+        """Totals over all calls (or those of one step), overall and per role"""
+        with self._lock:
+            records = [r for r in self.records if step is None or r["step"] == step]
+
+        def totals(rs):
+            total = {field: 0 for field in USAGE_FIELDS}
+            total["calls"] = sum(not r["skipped"] for r in rs)
+            for r in rs:
+                for field in USAGE_FIELDS:
+                    total[field] += r[field] or 0
+            return total
+
+        summary = totals(records)
+        summary["by_role"] = {
+            role: totals([r for r in records if (r["role"] or "") == role])
+            for role in sorted({r["role"] or "" for r in records})
+        }
+        return summary
@@ -4,7 +4,9 @@ import textwrap
 
 class PROCEDURAL_MEMORY:
     @staticmethod
-    def construct_simple_worker_procedural_memory(agent_class, skipped_actions):
+    def construct_simple_worker_procedural_memory(
+        agent_class, skipped_actions, max_actions=1
+    ):
         procedural_memory = textwrap.dedent(
             f"""\
         You are an expert in graphical user interfaces and Python code and and specifically web-based word puzzle games. You are responsible for executing the current game action: `SUBTASK_DESCRIPTION` as part of the strategy: `TASK_DESCRIPTION`.
@@ -72,6 +74,16 @@ class PROCEDURAL_MEMORY:
         """
         )
 
+        # Multi-action plans: a short sequence run back-to-back without new screenshots
+        if max_actions > 1:
+            procedural_memory = procedural_memory.replace(
+                "5. One action per code block.",
+                f"5. Up to {max_actions} actions per code block, one per line, executed back-to-back without a new screenshot in between. "
+                "Only the first action may refer to a screen element by its description, the following ones must not need to locate anything on the screen "
+                "(e.g. agent.click(\"The close button of the popup\", 1, \"left\") followed by agent.type(text=\"<guess>\", enter=True)). "
+                "Use a single action when the next step depends on what the screen will show.",
+            )
+
         return procedural_memory.strip()
 
     # For reflection agent, post-action verification mainly for cycle detection
@@ -93,6 +105,22 @@ class PROCEDURAL_MEMORY:
     """
     )
 
+    # For the rolling summary of older turns, given to the reflection agent in their place
+    SUMMARIZE_TRAJECTORY = textwrap.dedent(
+        """
+    You are an expert at condensing the trajectory of a computer agent playing a word puzzle game.
+    You are given the previous summary of the trajectory, the next turns to fold into it (each with the agent's reasoning and action) and facts extracted from every turn so far.
+    Write an updated summary with exactly these sections:
+    Guesses made: every word entered so far, in order.
+    Color feedback: the colors reported for each guess, and the letters known to be correct, misplaced or absent.
+    Detected loops: actions or guesses that were repeated without progress, or "none".
+    
+    Rules:
+    - Only report what the turns and facts state, never invent guesses or feedback.
+    - Keep it short: no reasoning, no advice, no next steps.
+    """
+    )
+
     PHRASE_TO_WORD_COORDS_PROMPT = textwrap.dedent(
         """
     You are an expert in graphical user interfaces. Your task is to process a phrase of text, and identify the most relevant word on the computer screen.
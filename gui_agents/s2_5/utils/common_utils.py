@@ -1,28 +1,53 @@
+import hashlib
+import json
 import re
-import time
-
-from typing import Tuple
-
-
-def call_llm_safe(agent, temperature: float = 0.0, use_thinking: bool = False) -> str:
-    # Retry if fails
-    max_retries = 3  # Set the maximum number of retries
-    attempt = 0
-    response = ""
-    while attempt < max_retries:
-        try:
-            response = agent.get_response(
-                temperature=temperature, use_thinking=use_thinking
-            )
-            assert response is not None, "Response from agent should not be None"
-            break  # If successful, break out of the loop
-        except Exception as e:
-            attempt += 1
-            print(f"Attempt {attempt} failed: {e}")
-            if attempt == max_retries:
-                print("Max retries reached. Handling failure.")
-        time.sleep(1.0)
-    return response if response is not None else ""
+
+from typing import Dict, List, Optional, Tuple
+
+from gui_agents.s2_5.core.image_store import ImageRef
+
+
+def call_llm_safe(
+    agent, temperature: float = 0.0, use_thinking: bool = False, **kwargs
+) -> str:
+    """Get a response from agent, raising if the call fails.
+
+    Retries, backoff and the step/game time budgets are applied once, by the engine
+    (see core/retry.py), so failures are not retried again here or hidden behind "".
+    """
+    response = agent.get_response(
+        temperature=temperature, use_thinking=use_thinking, **kwargs
+    )
+    if response is None:
+        raise ValueError("Response from agent should not be None")
+    return response
+
+
+# Matches both ```code``` and ```python code```, capturing the code (possibly multi-line)
+CODE_BLOCK_PATTERN = re.compile(r"```(?:\w+\s+)?(.*?)```", re.DOTALL)
+
+
+def grounded_action_complete(response: str) -> bool:
+    """True once the first code block after the "Grounded Action" header has been closed"""
+    start = response.rfind("Grounded Action")
+    if start == -1:
+        return False
+    return CODE_BLOCK_PATTERN.search(response[start:]) is not None
+
+
+def reflection_case(reflection: str) -> Optional[int]:
+    """Which case (1 off plan, 2 on plan, 3 task done) a reflection reports, if any"""
+    match = re.search(r"\bCase\s*([123])\b", reflection or "", re.IGNORECASE)
+    if match:
+        return int(match.group(1))
+    text = (reflection or "").lower()
+    if "not going according to plan" in text:
+        return 1
+    if "successfully completed" in text or "has been completed" in text:
+        return 3
+    if "according to plan" in text or "continue proceeding" in text:
+        return 2
+    return None
 
 
 def split_thinking_response(full_response: str) -> Tuple[str, str]:
@@ -45,15 +70,8 @@ def parse_single_code_from_string(input_string):
     if input_string.strip() in ["WAIT", "DONE", "FAIL", "done", "fail"]:
         return input_string.strip()
 
-    # This regular expression will match both ```code``` and ```python code```
-    # and capture the `code` part. It uses a non-greedy match for the content inside.
-    pattern = r"```(?:\w+\s+)?(.*?)```"
-    # Find all non-overlapping matches in the string
-    matches = re.findall(pattern, input_string, re.DOTALL)
-
-    # The regex above captures the content inside the triple backticks.
-    # The `re.DOTALL` flag allows the dot `.` to match newline characters as well,
-    # so the code inside backticks can span multiple lines.
+    # Find all non-overlapping code blocks in the string
+    matches = CODE_BLOCK_PATTERN.findall(input_string)
 
     # matches now contains all the captured code snippets
 
@@ -94,12 +112,59 @@ def sanitize_code(code):
     return code
 
 
-def extract_first_agent_function(code_string):
-    # Regular expression pattern to match 'agent' functions with any arguments, including nested parentheses
-    pattern = r'agent\.[a-zA-Z_]+\((?:[^()\'"]|\'[^\']*\'|"[^"]*")*\)'
+AGENT_FUNCTION_PATTERN = re.compile(
+    r'agent\.[a-zA-Z_]+\((?:[^()\'"]|\'[^\']*\'|"[^"]*")*\)'
+)
+
 
-    # Find all matches in the string
-    matches = re.findall(pattern, code_string)
+def extract_agent_functions(code_string):
+    """Every agent.* call in code_string, in order"""
+    return AGENT_FUNCTION_PATTERN.findall(code_string)
 
-    # Return the first match if found, otherwise return None
-    return matches[0] if matches else None
+
+def extract_first_agent_function(code_string):
+    # Return the first agent function call if found, otherwise return None
+    match = AGENT_FUNCTION_PATTERN.search(code_string)
+    return match.group(0) if match else None
+
+
+def _payload_digest(payload) -> str:
+    # Stored ImageRef handles are already content-addressed, no need to resolve them
+    if isinstance(payload, ImageRef):
+        return payload.fingerprint()
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def normalize_messages(messages: List[Dict]) -> List[Dict]:
+    """Canonical form of a message list for hashing: plain-string content becomes a text part,
+    text is stripped and inline image payloads are replaced by their digest"""
+    normalized = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        parts = []
+        for part in content:
+            if part.get("type") == "text":
+                parts.append({"type": "text", "text": part.get("text", "").strip()})
+            elif part.get("type") == "image_url":
+                url = part["image_url"]["url"]
+                parts.append({"type": "image", "digest": _payload_digest(url)})
+            elif part.get("type") == "image":
+                data = part.get("source", {}).get("data", "")
+                parts.append({"type": "image", "digest": _payload_digest(data)})
+            else:
+                parts.append(part)
+        normalized.append({"role": message.get("role"), "content": parts})
+    return normalized
+
+
+def fingerprint_request(messages: List[Dict], **params) -> str:
+    """Content hash of a model request: its normalized messages plus any generation parameters"""
+    payload = json.dumps(
+        {"messages": normalize_messages(messages), "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
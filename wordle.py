@@ -1,8 +1,10 @@
-import os, io, sys, time, pyautogui
+import os, io, sys, time
 
 from gui_agents.s2_5.agents.agent_s import AgentS2_5
 from gui_agents.s2_5.agents.grounding import OSWorldACI
-from orgo import Computer
+from gui_agents.s2_5.core.engine import warm_up_engines
+from gui_agents.s2_5.core.retry import DeadlineExceeded, deadline
+from gui_agents.s2_5.core.screen_diff import ScreenChangeDetector
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.prompt import Prompt
@@ -21,17 +23,51 @@ CONFIG = {
     "grounding_type": os.getenv("GROUNDING_MODEL_TYPE", ""),
     "max_steps": int(os.getenv("MAX_STEPS", "50")),
     "step_delay": float(os.getenv("STEP_DELAY", "3.0")),
-    "remote": os.getenv("USE_CLOUD_ENVIRONMENT", "false").lower() == "true"
+    "remote": os.getenv("USE_CLOUD_ENVIRONMENT", "false").lower() == "true",
+    "stream": os.getenv("STREAM_RESPONSES", "false").lower() == "true",
+    "response_cache": os.getenv("RESPONSE_CACHE_DIR") or None,
+    "record_log": os.getenv("RECORD_LOG") or None,
+    "replay_log": os.getenv("REPLAY_LOG") or None,
+    "replay_realtime": os.getenv("REPLAY_REALTIME", "false").lower() == "true",
+    "hedge_model": os.getenv("HEDGE_MODEL", ""),
+    "hedge_type": os.getenv("HEDGE_MODEL_TYPE", ""),
+    "hedge_percentile": float(os.getenv("HEDGE_PERCENTILE", "95")),
+    "warm_up": os.getenv("WARM_UP_CONNECTIONS", "true").lower() == "true",
+    "step_budget": float(os.getenv("STEP_BUDGET_SECONDS", "120")),
+    "game_budget": float(os.getenv("GAME_BUDGET_SECONDS", "0")),
+    "grounding_batching": os.getenv("GROUNDING_BATCHING", "false").lower() == "true",
+    "image_preprocessing": os.getenv("IMAGE_PREPROCESSING", "true").lower() == "true",
+    "image_format": os.getenv("IMAGE_FORMAT", "png"),
+    "image_quality": int(os.getenv("IMAGE_QUALITY", "85")),
+    "reflection_detail": os.getenv("REFLECTION_IMAGE_DETAIL", "high"),
+    "image_store_mb": int(os.getenv("IMAGE_STORE_MEMORY_MB", "64")),
+    "image_spill_dir": os.getenv("IMAGE_SPILL_DIR") or None,
+    "context_token_budget": int(os.getenv("CONTEXT_TOKEN_BUDGET", "0")) or None,
+    "reflection_summary": os.getenv("REFLECTION_SUMMARY", "false").lower() == "true",
+    "summary_model": os.getenv("SUMMARY_MODEL"),
+    "speculative": os.getenv("SPECULATIVE_GENERATION", "false").lower() == "true",
+    "reflection_schedule": os.getenv("REFLECTION_SCHEDULE", "false").lower() == "true",
+    "reflection_heartbeat": int(os.getenv("REFLECTION_HEARTBEAT", "5")),
+    "max_actions": int(os.getenv("MAX_ACTIONS_PER_PLAN", "1")),
+    "action_delay": float(os.getenv("ACTION_DELAY", "0.5")),
+    "wordle_solver": os.getenv("WORDLE_SOLVER", "false").lower() == "true",
+    "wordle_word_list": os.getenv("WORDLE_WORD_LIST") or None,
+    "summary_type": os.getenv("SUMMARY_MODEL_TYPE"),
+    "skip_unchanged": os.getenv("SKIP_UNCHANGED_SCREENS", "false").lower() == "true",
+    "screen_change_threshold": float(os.getenv("SCREEN_CHANGE_THRESHOLD", "0.0002")),
 }
 
 
 class Executor:
     def __init__(self, remote=False):
         self.remote = remote
+        # Only the backend in use is imported: orgo for remote runs, pyautogui locally
         if remote:
+            from orgo import Computer
             self.computer = Computer()
             self.platform = "linux"
         else:
+            import pyautogui
             self.pyautogui = pyautogui
             self.platform = {"win32": "windows", "darwin": "darwin"}.get(sys.platform, "linux")
     
@@ -54,7 +90,46 @@ class Executor:
 
 
 def create_agent(executor):
-    params = {"engine_type": CONFIG["model_type"], "model": CONFIG["model"]}
+    # Resize to each provider's vision size (or the grounding size) before upload
+    image_preprocessing = CONFIG["image_preprocessing"] and {
+        "image_format": CONFIG["image_format"],
+        "quality": CONFIG["image_quality"],
+        "detail": {"reflection": CONFIG["reflection_detail"]},
+    }
+    # Images in agent messages live in one shared store, spilled to disk when it fills
+    image_store = {
+        "max_memory_bytes": CONFIG["image_store_mb"] * 1024 * 1024,
+        "spill_dir": CONFIG["image_spill_dir"],
+    }
+    params = {
+        "engine_type": CONFIG["model_type"],
+        "model": CONFIG["model"],
+        "stream": CONFIG["stream"],
+        "response_cache": CONFIG["response_cache"],
+        "record_to": CONFIG["record_log"],
+        "step_budget": CONFIG["step_budget"],
+        "image_preprocessing": image_preprocessing,
+        "image_store": image_store,
+        "skip_unchanged_screens": CONFIG["skip_unchanged"],
+        "screen_change_threshold": CONFIG["screen_change_threshold"],
+        "context_token_budget": CONFIG["context_token_budget"],
+        "reflection_summary": CONFIG["reflection_summary"],
+        "speculative_generation": CONFIG["speculative"],
+        # Reflect on errors, repeated actions, stalls and every few steps only
+        "reflection_schedule": CONFIG["reflection_schedule"]
+        and {"heartbeat": CONFIG["reflection_heartbeat"]},
+        "max_actions_per_plan": CONFIG["max_actions"],
+        # Guess locally from the board colors, the models only handle surprises
+        "wordle_solver": CONFIG["wordle_solver"]
+        and {"word_list": CONFIG["wordle_word_list"]},
+    }
+    # Older turns are summarized by a cheaper model if one is set, else by a template
+    if CONFIG["summary_model"] and CONFIG["summary_type"]:
+        params["summary_engine_params"] = {
+            "engine_type": CONFIG["summary_type"],
+            "model": CONFIG["summary_model"],
+            "record_to": CONFIG["record_log"],
+        }
     grounding_model_resize_width = 1366 #For anthropic models
     screen_width = 1024 #For Orgo VM
     screen_height = 768 #For Orgo VM
@@ -62,8 +137,37 @@ def create_agent(executor):
         "engine_type": CONFIG["grounding_type"], 
         "model": CONFIG["grounding_model"],
         "grounding_width": grounding_model_resize_width,
-        "grounding_height": (screen_height * grounding_model_resize_width) / screen_width
+        "grounding_height": (screen_height * grounding_model_resize_width) / screen_width,
+        "batching": CONFIG["grounding_batching"],
+        "image_preprocessing": image_preprocessing,
+        "image_store": image_store,
+        "response_cache": CONFIG["response_cache"],
+        "record_to": CONFIG["record_log"],
     }
+    # Hedge slow generator calls to a second provider
+    if CONFIG["hedge_model"] and CONFIG["hedge_type"]:
+        params["engines"] = [
+            {"engine_type": CONFIG["model_type"], "model": CONFIG["model"]},
+            {"engine_type": CONFIG["hedge_type"], "model": CONFIG["hedge_model"]},
+        ]
+        params["engine_type"] = "hedged"
+        params["hedge_percentile"] = CONFIG["hedge_percentile"]
+    # Play back a recorded run instead of calling the models
+    if CONFIG["replay_log"]:
+        for p in (params, grounding, params.get("summary_engine_params")):
+            if p is None:
+                continue
+            p.update(
+                engine_type="replay",
+                log_path=CONFIG["replay_log"],
+                realtime=CONFIG["replay_realtime"],
+                record_to=None,
+            )
+    # Open provider connections in the background while the game is being set up
+    elif CONFIG["warm_up"]:
+        warm_up_engines(
+            [p for p in (params, grounding, params.get("summary_engine_params")) if p]
+        )
     
     return AgentS2_5(
         engine_params=params,
@@ -71,35 +175,63 @@ def create_agent(executor):
         platform=executor.platform,
     )
 
+def run_actions(executor, actions, screenshot):
+    """Run a plan's actions back-to-back, stopping once one has no visible effect"""
+    detector = ScreenChangeDetector(CONFIG["screen_change_threshold"])
+    detector.changed(screenshot)
+    for i, code in enumerate(actions):
+        if code.strip().upper() in ("DONE", "FAIL"):
+            break
+        # The plan assumed each action works, stop if the screen did not follow along
+        if i:
+            time.sleep(CONFIG["action_delay"])
+            if not detector.changed(executor.screenshot()):
+                console.print(f"[yellow]Screen unchanged, skipping {len(actions) - i} planned action(s)[/]")
+                break
+        console.print(f"[bold magenta]🔧 Agent Action:[/] {code}")
+        executor.exec(code)
+
+
 def run_task(agent, executor, instruction):
     console.print(Panel(f"[bold cyan]GAME STARTS", box=box.ROUNDED))
     done_count = 0
+    last_error = None
 
-    for step in range(CONFIG["max_steps"]):
-        console.print(f"[bold blue]Step {step + 1}/{CONFIG['max_steps']}[/]")
+    # Every model call of the game shares one time budget (GAME_BUDGET_SECONDS)
+    with deadline(CONFIG["game_budget"], "game"):
+        for step in range(CONFIG["max_steps"]):
+            console.print(f"[bold blue]Step {step + 1}/{CONFIG['max_steps']}[/]")
         
-        if not done_count : console.print("[yellow]⏳ Guessing better than you...[/]")
-        if step: time.sleep(CONFIG["step_delay"])
-
-        try:
-            info, action = agent.predict(instruction=instruction, observation={"screenshot": executor.screenshot()})
-            #if info:
-             #   console.print(f"[italic green]💭 Thought:[/] {info}")
-
-            if not action or not action[0] or action[0].strip().upper() == "DONE":
-                done_count += 1
-                if done_count >= 2:
-                    console.print("[bold green]✅ Complete![/]")
-                    return True
-                continue
+            if not done_count : console.print("[yellow]⏳ Guessing better than you...[/]")
+            if step: time.sleep(CONFIG["step_delay"])
+
+            try:
+                observation = {"screenshot": executor.screenshot(), "last_action_error": last_error}
+                last_error = None
+                info, action = agent.predict(instruction=instruction, observation=observation)
+                #if info:
+                 #   console.print(f"[italic green]💭 Thought:[/] {info}")
+
+                if not action or not action[0] or action[0].strip().upper() == "DONE":
+                    done_count += 1
+                    if done_count >= 2:
+                        console.print("[bold green]✅ Complete![/]")
+                        return True
+                    continue
 
-            done_count = 0
-            console.print(f"[bold magenta]🔧 Agent Action:[/] {action[0]}")
-            executor.exec(action[0])
+                done_count = 0
+                run_actions(executor, action, observation["screenshot"])
 
-        except Exception as e:
-            console.print(f"[bold red]❌ Error:[/] {e}")
-            done_count = 0
+            except DeadlineExceeded as e:
+                if e.scope == "game":
+                    console.print("[bold red]⏱️ Game time budget spent[/]")
+                    return False
+                console.print(f"[bold red]❌ Step gave up:[/] {e}")
+                done_count = 0
+            except Exception as e:
+                console.print(f"[bold red]❌ Error:[/] {e}")
+                last_error = str(e)
+                done_count = 0
 
     console.print("[bold red]⏱️ Max steps reached[/]")
     return False